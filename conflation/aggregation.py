@@ -1,10 +1,10 @@
+import collections
 import copy
 import json
 import logging
 import numpy as np
 import os
 import pandas as pd
-import pickle
 import re
 from typing import Optional
 
@@ -89,10 +89,14 @@ def run(map_matches_dir: str, results_dir: str) -> None:
     for subdir, dirs, files in os.walk(map_matches_dir):  # Iterating over countries
         # Pull the country using the name of the subdir
         country = os.path.basename(os.path.normpath(subdir))
-        regions = {}
+        regions = collections.defaultdict(list)
         country_level_data = []
 
         for file in files:  # Iterating over regions
+            # Skip any region file that was left half-written by a crashed map matching run
+            if file.endswith(util.TEMP_FILE_EXTENSION):
+                continue
+
             # Pull the region using the pickle filename
             region = file.split(".")[0].split(util.MAP_MATCH_REGION_FILENAME_DELIMITER)[0]
 
@@ -104,7 +108,7 @@ def run(map_matches_dir: str, results_dir: str) -> None:
                         country, region, map_match_data_filename
                     )
                 )
-                map_match_data: list[tuple] = pickle.load(open(map_match_data_filename, "rb"))
+                map_match_data: list[tuple] = util.load_pickle(map_match_data_filename)
             except (OSError, IOError):
                 logging.critical("{} pickle could not be loaded. Cannot perform aggregation.")
                 continue
@@ -112,10 +116,7 @@ def run(map_matches_dir: str, results_dir: str) -> None:
             # Combine the data with other data from the same region. Sometimes the region isn't detected and it's just
             # an empty string. In this case, don't add it to the regions dict but add it to the overall country data
             if region:
-                if region not in regions:
-                    regions[region] = map_match_data
-                else:
-                    regions[region].extend(map_match_data)
+                regions[region].extend(map_match_data)
 
             # Aggregate country level statistics
             country_level_data.extend(map_match_data)
@@ -1,11 +1,20 @@
+import collections
 import logging
 import multiprocessing
+import numpy as np
 import os
-import pickle
 import requests
+from typing import Optional
 
 from conflation import util
 
+# Valhalla's Python bindings are an optional dependency that let us map match in-process, rather than through HTTP calls
+# to a running Valhalla service
+try:
+    import valhalla as valhalla_bindings
+except ImportError:
+    valhalla_bindings = None
+
 VALHALLA_MAP_MATCHING_URL_EXTENSION = "trace_attributes"
 
 MAXIMUM_UNMATCHED_PERCENTAGE = (
@@ -36,33 +45,52 @@ def run(traces_dir: str, map_matches_dir: str, processes: int, config: dict) ->
     """
     sections_filename = util.get_sections_filename(traces_dir)
 
+    # Valhalla is run in-process if the user gave a Valhalla config and the bindings are installed
+    if "valhalla_config" in config and valhalla_bindings is None:
+        logging.warning(
+            '"valhalla_config" given but the valhalla Python bindings are not installed. Using "base_url" instead...'
+        )
+
     # Do a quick check to see if user specified the mandatory 'base_url' in config JSON
-    if "base_url" not in config:
+    if "base_url" not in config and (
+        "valhalla_config" not in config or valhalla_bindings is None
+    ):
         raise KeyError(
             'Missing "base_url" (Mapillary Client ID) key in --map-matching-config JSON.'
         )
 
+    if "valhalla_config" in config and valhalla_bindings is not None:
+        # Load one actor up front, so a bad config fails here. Failing in the pool initializer instead would kill every
+        # process at startup, and the pool would just keep respawning them without making any progress
+        try:
+            valhalla_bindings.Actor(config["valhalla_config"])
+        except Exception as e:
+            raise ValueError(
+                'Could not load Valhalla from "valhalla_config" in --map-matching-config JSON: {}'.format(
+                    repr(e)
+                )
+            ) from e
+
     try:
         logging.info("Reading bbox_sections from disk...")
-        bbox_sections: list[tuple[str, str]] = pickle.load(open(sections_filename, "rb"))
+        bbox_sections: list[tuple[str, str]] = util.load_pickle(sections_filename)
     except (OSError, IOError):
         raise FileNotFoundError(
             "bbox sections pickle could not be loaded from /output/traces. Cannot perform map matching."
         )
 
-    finished_bbox_sections = multiprocessing.Value("i", 0)
     with multiprocessing.Pool(
         initializer=initialize_multiprocess,
-        initargs=(map_matches_dir, config, finished_bbox_sections),
+        initargs=(traces_dir, map_matches_dir, config),
         processes=processes,
     ) as pool:
-        result = pool.map_async(map_match_for_bbox, bbox_sections)
+        results = pool.imap_unordered(map_match_for_bbox, bbox_sections)
 
         progress = 0
         increment = 5
-        while not result.ready():
-            result.wait(timeout=5)
-            next_progress = int(finished_bbox_sections.value / len(bbox_sections) * 100)
+        # Each yielded result is a finished bbox section, so progress is tracked here without any shared counter
+        for finished_bbox_sections, _ in enumerate(results, 1):
+            next_progress = int(finished_bbox_sections / len(bbox_sections) * 100)
             if int(next_progress / increment) > progress:
                 logging.info("Current progress: {}%".format(next_progress))
                 progress = int(next_progress / increment)
@@ -71,9 +99,9 @@ def run(traces_dir: str, map_matches_dir: str, processes: int, config: dict) ->
 
 
 def initialize_multiprocess(
+    traces_dir_: str,
     global_map_matches_dir_: str,
     global_config_: dict,
-    finished_bbox_sections_: multiprocessing.Value,
 ) -> None:
     """
     Initializes global variables referenced / updated by all threads of the multiprocess map matching requests.
@@ -82,14 +110,31 @@ def initialize_multiprocess(
     global global_map_matches_dir
     global_map_matches_dir = global_map_matches_dir_
 
-    # Integer counter of num of finished bbox_sections
-    global finished_bbox_sections
-    finished_bbox_sections = finished_bbox_sections_
-
     # So each process knows the conf provided
     global global_config
     global_config = global_config_
 
+    # Requests session for persistent connections, so each process reuses its connection to Valhalla rather than
+    # opening a new one for every sequence. Each process makes one call at a time, so it only needs a single
+    # connection. A trace_attributes call doesn't change anything on the server, so it's safe to retry
+    global session
+    session = util.make_api_session(1, retry_posts=True)
+    # The request bodies are serialized by util.dump_json(), so we have to set the content type ourselves
+    session.headers["Content-Type"] = "application/json"
+
+    # Each process loads its own in-process Valhalla actor, if the conf asks for one
+    global actor
+    actor = (
+        valhalla_bindings.Actor(global_config_["valhalla_config"])
+        if "valhalla_config" in global_config_ and valhalla_bindings is not None
+        else None
+    )
+
+    # Snapshot of the files already in the traces dir, so each process can skip bbox sections that were map matched by
+    # a previous run without having to stat the filesystem for every one of them
+    global global_existing_filenames
+    global_existing_filenames = util.get_existing_filenames(traces_dir_)
+
 
 def map_match_for_bbox(bbox_sections: tuple) -> None:
     """
@@ -106,45 +151,133 @@ def map_match_for_bbox(bbox_sections: tuple) -> None:
         processed_trace_filename = util.get_processed_trace_filename(trace_filename)
 
         # Check to see if the trace has already been processed by map_matching
-        if os.path.exists(processed_trace_filename):
+        if processed_trace_filename in global_existing_filenames:
             logging.info("Map matching already complete for bbox={}. Skipping...".format(bbox))
-            with finished_bbox_sections.get_lock():
-                finished_bbox_sections.value += 1
             return
 
-        trace_data: list[list[dict]] = pickle.load(open(trace_filename, "rb"))
-        map_matches = {}
-        [add_map_matches_for_shape(map_matches, shape, global_config) for shape in trace_data]
+        # Map matches follow a country -> region -> [edge data] hierarchy
+        map_matches = collections.defaultdict(lambda: collections.defaultdict(list))
+        for sequence in util.load_trace_sequences(trace_filename):
+            add_map_matches_for_shape(
+                session, actor, map_matches, util.columns_to_sequence(sequence), global_config
+            )
         if len(map_matches):
             write_map_matches(global_map_matches_dir, map_matches)
 
         # Once all results have been written, mark the file as processed by renaming
-        os.rename(trace_filename, processed_trace_filename)
-        with finished_bbox_sections.get_lock():
-            finished_bbox_sections.value += 1
+        os.replace(trace_filename, processed_trace_filename)
     except Exception as e:
         logging.error("Failed to map match using Valhalla: {}".format(repr(e)))
 
 
 def add_map_matches_for_shape(
-    map_matches: dict[str, dict[str, list[tuple]]], shape: any, conf: dict
+    session_: requests.Session,
+    actor_: any,
+    map_matches: dict[str, dict[str, list[tuple]]],
+    shape: any,
+    conf: dict,
 ) -> None:
     """
     Calls Valhalla API with the given shape dict and adds the map matching results to map_matches in place. Does some
     filtering for bad map matches if there are too many unmatched points or if the elapsed time isn't monotonically
     increasing.
 
-    :param map_matches: Dict of already existing map matches
+    :param session_: requests.Session() to persist connections across API calls
+    :param actor_: In-process valhalla.Actor to map match with, or None to call the Valhalla service over HTTP instead
+    :param map_matches: Already existing map matches, as nested country -> region defaultdicts of lists
     :param shape: "Shape" object that is passed into Valhalla's APIs. See Valhalla's README for more specifications
     :param conf: Dict of configs. See "--map-matching-config" section of README for keys
     """
     body = {"shape": shape, "costing": "auto", "shape_match": "map_snap", "use_timestamps": True}
+
+    if actor_ is not None:
+        # The bindings take and return JSON strings, but skip the HTTP round trip and the service's request handling
+        try:
+            resp = util.parse_json(
+                actor_.trace_attributes(util.dump_json(body).decode("UTF-8"))
+            )
+        except RuntimeError as e:
+            # Same as a 400 from the service: a match could not be made, so we'll just skip the sequence
+            logging.warning("Skipping b/c Valhalla could not match: {}".format(repr(e)))
+            return
+    else:
+        resp = request_trace_attributes(session_, body, conf)
+        if resp is None:
+            return
+
+    if has_too_many_unmatched(resp["matched_points"]):
+        logging.debug("Skipping map match b/c too many points unmatched")
+        return
+
+    # TODO: Figure out the funky math for the first and last edges
+    edges = resp["edges"][1:-1]
+    # The elapsed time at the end of each edge, starting with the first edge (which we otherwise skip)
+    times = np.fromiter(
+        (e["end_node"]["elapsed_time"] for e in resp["edges"][: len(edges) + 1]),
+        dtype=np.float64,
+        count=len(edges) + 1,
+    )
+    # Kilometers
+    lengths = np.fromiter((e["length"] for e in edges), dtype=np.float64, count=len(edges))
+    t_elapsed_on_ways = np.diff(times)  # Seconds
+
+    # If the elapsed time doesn't increase for some reason, we can't make any measurement on that edge, so we will
+    # ignore it
+    is_measurable = t_elapsed_on_ways > 0
+    kphs = np.zeros(len(edges))
+    np.divide(lengths, t_elapsed_on_ways, out=kphs, where=is_measurable)
+    kphs *= 3600
+
+    # The elapsed time should be monotonically increasing, and measurements shouldn't be going too fast. The first edge
+    # where either isn't the case means this is a bad match, so we stop there (keeping the edges before it)
+    is_bad = (t_elapsed_on_ways < 0) | (kphs > MAXIMUM_SPEED)
+    num_edges = int(is_bad.argmax()) if is_bad.any() else len(edges)
+    # Only build the skip message when it will actually be logged, since this runs for every shape
+    if num_edges < len(edges) and logging.getLogger().isEnabledFor(logging.DEBUG):
+        if t_elapsed_on_ways[num_edges] < 0:
+            logging.debug(
+                "Skipping map match b/c time not monotonically increasing {} -> {}".format(
+                    times[num_edges], times[num_edges + 1]
+                )
+            )
+        else:
+            logging.debug(
+                "Skipping map match b/c kph of {} > limit of {}".format(
+                    kphs[num_edges], MAXIMUM_SPEED
+                )
+            )
+
+    kphs = kphs.tolist()
+    for i in np.flatnonzero(is_measurable[:num_edges]).tolist():
+        e = edges[i]
+        admin = resp["admins"][e["end_node"]["admin_index"]]
+        country, region = admin["country_code"], admin["state_code"]
+        # OSM name for the service road class is "service", whereas Valhalla outputs "service_other"
+        road_class = e["road_class"] if e["road_class"] != "service_other" else "service"
+
+        # Ordered tuple that holds all the information that we need to classify this edge, as well as the speed
+        # calculated. See aggregation.MAP_MATCH_COLS for the meaning of each column
+        edge_data = (classify_density(e["density"]), road_class, get_type_for_edge(e), kphs[i])
+        map_matches[country][region].append(edge_data)
+
+
+def request_trace_attributes(
+    session_: requests.Session, body: dict, conf: dict
+) -> Optional[dict]:
+    """
+    Calls the trace_attributes API of the Valhalla service with the given request body.
+
+    :param session_: requests.Session() to persist connections across API calls
+    :param body: Request body, holding the shape to map match
+    :param conf: Dict of configs. See "--map-matching-config" section of README for keys
+    :return: The parsed response, or None if Valhalla could not make a match
+    """
     base_url = conf["base_url"]
     headers = conf["headers"] if "headers" in conf else None
 
-    resp = requests.post(
+    resp = session_.post(
         base_url + VALHALLA_MAP_MATCHING_URL_EXTENSION,
-        json=body,
+        data=util.dump_json(body),
         headers=headers,
     )
 
@@ -153,7 +286,7 @@ def add_map_matches_for_shape(
         # sequence.
         if resp.status_code == 400:
             logging.warning("Skipping b/c 400 response from Valhalla: {}".format(resp.json()))
-            return
+            return None
 
         # Any other status code and we want to report an error.
         raise ConnectionError(
@@ -162,53 +295,7 @@ def add_map_matches_for_shape(
             )
         )
 
-    resp = resp.json()
-
-    if has_too_many_unmatched(resp["matched_points"]):
-        logging.debug("Skipping map match b/c too many points unmatched")
-        return
-
-    prev_t = resp["edges"][0]["end_node"]["elapsed_time"]
-    # TODO: Figure out the funky math for the first and last edges
-    for e in resp["edges"][1:-1]:
-        way_length = e["length"]  # Kilometers
-        density_value = e["density"]
-        admin = resp["admins"][e["end_node"]["admin_index"]]
-        country, region = admin["country_code"], admin["state_code"]
-        # OSM name for the service road class is "service", whereas Valhalla outputs "service_other"
-        road_class = e["road_class"] if e["road_class"] != "service_other" else "service"
-        t = e["end_node"]["elapsed_time"]
-        t_elapsed_on_way = t - prev_t  # Seconds
-
-        # The elapsed time should be monotonically increasing. If not, this is a bad match and we will skip it
-        if t < prev_t:
-            logging.debug(
-                "Skipping map match b/c time not monotonically increasing {} -> {}".format(
-                    prev_t, t
-                )
-            )
-            return
-        # If the elapsed time doesn't increase for some reason, we can't make any measurement here, so we will ignore it
-        if t == prev_t:
-            # json.dumps([{'lon': b['lon'], 'lat': b['lat'], 'type': b['type'], 'time': i} for i, b in
-            #             enumerate(reversed(body['shape']))])
-            continue
-
-        kph = way_length / t_elapsed_on_way * 3600
-
-        # Skip measurements that are going too fast
-        if kph > MAXIMUM_SPEED:
-            logging.debug(
-                "Skipping map match b/c kph of {} > limit of {}".format(kph, MAXIMUM_SPEED)
-            )
-            return
-
-        # Ordered tuple that holds all the information that we need to classify this edge, as well as the speed
-        # calculated. See aggregation.MAP_MATCH_COLS for the meaning of each column
-        edge_data = (classify_density(density_value), road_class, get_type_for_edge(e), kph)
-        add_data_to_map_matches(map_matches, country, region, edge_data)
-
-        prev_t = t
+    return util.load_json(resp)
 
 
 def write_map_matches(
@@ -240,7 +327,10 @@ def write_map_matches(
                     len(rows), region_filename
                 )
             )
-            pickle.dump(rows, open(region_filename, "wb"))
+            # Written under a temp name first, so a crash mid-write can't leave a partial region file for aggregation
+            temp_filename = region_filename + util.TEMP_FILE_EXTENSION
+            util.dump_pickle(rows, temp_filename, sync=True)
+            os.replace(temp_filename, region_filename)
 
 
 def get_type_for_edge(edge: any) -> str:
@@ -285,25 +375,11 @@ def classify_density(density: float) -> str:
         return DENSITY_CLASSIFICATIONS[2]
 
 
-def add_data_to_map_matches(
-    map_matches: dict[str, dict[str, list[tuple]]], country: str, region: str, data: tuple
-) -> None:
-    """
-    Helper function to add a new measurement to the existing map_matches dict. Follows a country -> region -> [speeds]
-    hierarchy.
-    """
-    if country not in map_matches:
-        map_matches[country] = {}
-    if region not in map_matches[country]:
-        map_matches[country][region] = [data]
-    else:
-        map_matches[country][region].append(data)
-
-
 def has_too_many_unmatched(matched_points: list[any]) -> bool:
     """
     Checks over the matched points and returns True if there are too many unmatched points, which means we should simply
     scrap this sequence.
     """
-    num_unmatched = sum([1 if mp["type"] == "unmatched" else 0 for mp in matched_points])
+    # list.count() does the comparisons in C, rather than summing a list of Python ints
+    num_unmatched = [mp["type"] for mp in matched_points].count("unmatched")
     return num_unmatched / len(matched_points) > MAXIMUM_UNMATCHED_PERCENTAGE
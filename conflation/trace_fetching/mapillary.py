@@ -1,14 +1,14 @@
+import concurrent.futures
 import datetime
+import functools
 import logging
 import math
-import multiprocessing
+import numpy as np
 import os
-import pickle
 import requests
 from dateutil import parser
 from ratelimit import limits, sleep_and_retry
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
+from typing import Iterator, Optional
 
 from conflation import util, trace_filter
 from conflation.trace_fetching import vector_tile_pb2, routable_z5_tiles
@@ -29,6 +29,8 @@ COVERAGE_ZOOM = 5
 BBOX_SECTION_ZOOM = 14
 # The size of the sequence ID blocks that each thread will handle when pulling images
 SEQUENCE_ID_BLOCK_SIZE = 10
+# The number of threads each sequence ID block uses to pull the images of its sequences concurrently
+SEQUENCE_THREADS_PER_BLOCK = 4
 
 # Name of the dir where we store sequence IDs pulled from Mapillary
 SEQUENCE_IDS_DIR_NAME = "seq_ids"
@@ -41,10 +43,8 @@ SEQUENCE_URL = "https://graph.mapillary.com/image_ids?fields=id&sequence_id={}&a
 IMAGES_URL = "https://graph.mapillary.com/images?fields=captured_at,geometry&image_ids={}&access_token={}"
 
 # For all of the Mapillary calls, we need to rate limit them. The rate limit is 60k / min (last updated: 12/2021); we
-# give a small leeway to make sure we don't go over
-# Note(rzyc): The API calls are made from different processes and the `ratelimit` module currently rate limits within
-#  each individual process but not globally. So we will later have to divide up this global rate limit by the number
-#  of processes
+# give a small leeway to make sure we don't go over. All the API calls are made from threads of the same process, so
+# the `ratelimit` module enforces this limit globally
 MAPILLARY_MAX_CALLS_PER_MINUTE = 59000
 MAPILLARY_PERIOD_MINUTE = 60
 
@@ -70,18 +70,12 @@ def run(
     :param traces_dir: Dir where trace data will be pickled to
     :param tmp_dir: Dir where temp output files will be stored (should be empty upon completion)
     :param config: Dict of configs. See "--trace-config" section of README for keys
-    :param processes: Number of threads to use
+    :param processes: Number of processes requested; util.THREADS_PER_PROCESS threads are used for each of them
     :param access_token: Mapillary v4 access token (obtained through OAuth)
     """
 
-    # Requests session for persistent connections and timeout settings
-    session = requests.Session()
-    retry_strategy = Retry(
-        total=5, status_forcelist=[429, 500, 502, 503, 504], backoff_factor=3
-    )
-    adapter = HTTPAdapter(max_retries=retry_strategy)
-    session.mount("https://", adapter)
-    session.mount("http://", adapter)
+    threads = processes * util.THREADS_PER_PROCESS
+    session = util.make_api_session(threads * SEQUENCE_THREADS_PER_BLOCK)
 
     # We only want to consider recent sequences, so we take `start_date` as an optional param, and only consider
     # sequences dated past this given date
@@ -101,38 +95,16 @@ def run(
     # Break the bbox into sections and save it to a pickle file
     bbox_sections = split_bbox(session, sequence_ids_dir, bbox, access_token, start_date_epoch)
 
-    # Multiprocess values to keep track of progress when we are running multi-threaded tasks
-    finished_bbox_sections = multiprocessing.Value("i", 0)
-    finished_sequence_id_blocks = multiprocessing.Value("i", 0)
-    skipped_sequences_due_to_filters = multiprocessing.Value("i", 0)
-
-    # Divide up the total rate limit by the number of processes
-    mapillary_max_calls_per_process_per_minute = round(
-        MAPILLARY_MAX_CALLS_PER_MINUTE / processes
-    )
+    initialize_globals(session, access_token, traces_dir, tmp_dir, config, start_date_epoch)
 
-    with multiprocessing.Pool(
-        initializer=initialize_multiprocess,
-        initargs=(
-            session,
-            access_token,
-            tmp_dir,
-            config,
-            finished_bbox_sections,
-            finished_sequence_id_blocks,
-            start_date_epoch,
-            skipped_sequences_due_to_filters,
-            mapillary_max_calls_per_process_per_minute,
-        ),
-        processes=processes,
-    ) as pool:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
         # This file holds the blocks of unique sequence IDs that we've pulled from Mapillary. See if it already exists;
         # if it does then we don't need to pull sequence IDs from Mapillary again
         traces_sections_filename = util.get_sections_filename(traces_dir)
         try:
             logging.info("Reading sequence ID sections from disk...")
-            sequence_id_blocks: list[tuple[list[str], str]] = pickle.load(
-                open(traces_sections_filename, "rb")
+            sequence_id_blocks: list[tuple[list[str], str]] = util.load_pickle(
+                traces_sections_filename
             )
         except (OSError, IOError):
             logging.info(
@@ -144,21 +116,23 @@ def run(
                 )
             )
 
-            # Run the multiprocess job that takes all the bbox_sections, and pulls all the sequence IDs that are within
-            # each section
-            results = pool.imap_unordered(pull_sequence_ids_for_bbox, bbox_sections)
+            # Run the multi-threaded job that takes all the bbox_sections, and pulls all the sequence IDs that are
+            # within each section
+            futures = [executor.submit(pull_sequence_ids_for_bbox, s) for s in bbox_sections]
 
             progress = 0
             increment = 5
-            for result in results:
-                if not result:
+            # Each completed future is a finished bbox section, so progress is tracked here without any shared counter
+            for finished_bbox_sections, future in enumerate(
+                concurrent.futures.as_completed(futures), 1
+            ):
+                if not future.result():
                     # If pull_sequence_ids_for_bbox returns false, it is likely that we were IP banned by the Mapillary
                     # tiles endpoint. Exit entirely if this is the case
                     logging.error("Failed to pull sequence IDs for bbox_sections.")
-                    pool.close()
-                    pool.terminate()
+                    executor.shutdown(wait=False, cancel_futures=True)
                     raise ConnectionError
-                next_progress = int(finished_bbox_sections.value / len(bbox_sections) * 100)
+                next_progress = int(finished_bbox_sections / len(bbox_sections) * 100)
                 if int(next_progress / increment) > progress:
                     logging.info("Current progress: {}%".format(next_progress))
                     progress = int(next_progress / increment)
@@ -173,22 +147,26 @@ def run(
             )
             sequence_id_blocks = find_unique_sequence_ids(bbox_sections, traces_dir)
 
-            pickle.dump(sequence_id_blocks, open(traces_sections_filename, "wb"))
+            util.dump_pickle(sequence_id_blocks, traces_sections_filename)
 
-        # Run the multiprocess job that goes through all unique sequence IDs and actually pulls the images / coordinates
-        # for each sequence
-        result = pool.map_async(
-            pull_filter_and_save_trace_for_sequence_ids, sequence_id_blocks
-        )
+        # Run the multi-threaded job that goes through all unique sequence IDs and actually pulls the images /
+        # coordinates for each sequence
+        futures = [
+            executor.submit(pull_filter_and_save_trace_for_sequence_ids, b)
+            for b in sequence_id_blocks
+        ]
 
         logging.info("Placing {} results in {}...".format(len(sequence_id_blocks), traces_dir))
         progress = 0
         increment = 5
-        while not result.ready():
-            result.wait(timeout=5)
-            next_progress = int(
-                finished_sequence_id_blocks.value / len(sequence_id_blocks) * 100
-            )
+        # Each completed future gives the number of sequences that were filtered out of a finished block, so we can add
+        # them up here rather than having the threads update a shared counter
+        skipped_sequences_due_to_filters = 0
+        for finished_sequence_id_blocks, future in enumerate(
+            concurrent.futures.as_completed(futures), 1
+        ):
+            skipped_sequences_due_to_filters += future.result()
+            next_progress = int(finished_sequence_id_blocks / len(sequence_id_blocks) * 100)
             if int(next_progress / increment) > progress:
                 logging.info("Current progress: {}%".format(next_progress))
                 progress = int(next_progress / increment)
@@ -197,26 +175,23 @@ def run(
 
         logging.info(
             "Note: {} sequences were skipped because of filters.".format(
-                skipped_sequences_due_to_filters.value
+                skipped_sequences_due_to_filters
             )
         )
 
         return
 
 
-def initialize_multiprocess(
+def initialize_globals(
     session_: requests.Session,
     access_token_: str,
+    traces_dir_: str,
     global_tmp_dir_: str,
     global_config_: dict,
-    finished_bbox_sections_: multiprocessing.Value,
-    finished_sequence_id_blocks_: multiprocessing.Value,
     start_date_epoch_: int,
-    skipped_sequences_due_to_filters_: multiprocessing.Value,
-    mapillary_max_calls_per_process_per_minute_: int,
 ) -> None:
     """
-    Initializes global variables referenced / updated by all threads of the multiprocess API requests.
+    Initializes global variables referenced by all threads of the multi-threaded API requests.
     """
     global session
     session = session_
@@ -224,35 +199,37 @@ def initialize_multiprocess(
     global access_token
     access_token = access_token_
 
-    # So each process knows the output / tmp dirs
-    global global_tmp_dir
-    global_tmp_dir = global_tmp_dir_
+    # So each thread knows the output / tmp dirs. The tmp dir is kept with a trailing separator, so temp filenames are
+    # built by appending to it and we don't need to do an os.path.join for every task
+    global global_tmp_dir_prefix
+    global_tmp_dir_prefix = os.path.join(global_tmp_dir_, "")
+
+    # Where the Mapillary API responses are cached, if the conf asks for it
+    global global_page_cache_dir
+    global_page_cache_dir = util.get_page_cache_dir(global_tmp_dir_, global_config_)
 
-    # So each process knows the conf provided
+    # So each thread knows the conf provided
     global global_config
     global_config = global_config_
 
-    # Integer counter of num of finished bbox_sections
-    global finished_bbox_sections
-    finished_bbox_sections = finished_bbox_sections_
-
-    # Integer counter of num of finished finished_sequence_id_blocks
-    global finished_sequence_id_blocks
-    finished_sequence_id_blocks = finished_sequence_id_blocks_
+    # Snapshot of the files already in the traces dir and the sequence IDs dir, so each thread can skip finished bbox
+    # sections and sequence ID blocks without having to stat the filesystem for every one of them
+    global global_existing_filenames
+    global_existing_filenames = util.get_existing_filenames(traces_dir_)
+    global_existing_filenames |= util.get_existing_filenames(
+        os.path.join(global_tmp_dir_, SEQUENCE_IDS_DIR_NAME)
+    )
 
     global start_date_epoch
     start_date_epoch = start_date_epoch_
 
-    global skipped_sequences_due_to_filters
-    skipped_sequences_due_to_filters = skipped_sequences_due_to_filters_
-
-    # Introduce decorators to the global rate limit check function; each thread gets their own version of this decorated
-    # function with a rate limit of (GLOBAL_RATE_LIMIT / #processes) / TIME_PERIOD
+    # Introduce decorators to the global rate limit check function; all threads share this decorated function with a
+    # rate limit of GLOBAL_RATE_LIMIT / TIME_PERIOD
     global check_rate_limit
     check_rate_limit = sleep_and_retry(
-        limits(
-            calls=mapillary_max_calls_per_process_per_minute_, period=MAPILLARY_PERIOD_MINUTE
-        )(check_rate_limit_undecorated)
+        limits(calls=MAPILLARY_MAX_CALLS_PER_MINUTE, period=MAPILLARY_PERIOD_MINUTE)(
+            check_rate_limit_undecorated
+        )
     )
 
 
@@ -260,7 +237,7 @@ def pull_sequence_ids_for_bbox(bbox_section: tuple[int, int, str]) -> bool:
     """
     First, check to see if a bbox section already had sequence IDs pulled onto disk. If not, pull all sequence IDs
     within the current bbox section from Mapillary by calling make_sequence_ids_requests() and save it to disk. Meant to
-    be run in a multi-threaded manner and references global vars made by initialize_multiprocess().
+    be run in a multi-threaded manner and references global vars made by initialize_globals().
 
     :param bbox_section: tuple where [0:1] indices: [x,y] coordinate of the zoom 14 tile, [2] index: the filename where
         the pulled sequence IDs should be stored
@@ -269,26 +246,19 @@ def pull_sequence_ids_for_bbox(bbox_section: tuple[int, int, str]) -> bool:
         tile, sequence_ids_filename = bbox_section[0:2], bbox_section[2]
 
         # If either we have already pulled sequence IDs to disk, don't pull it again
-        if os.path.exists(sequence_ids_filename):
+        if sequence_ids_filename in global_existing_filenames:
             logging.info(
                 "Seq IDs already exists on disk for tile={}. Skipping...".format(tile)
             )
-            with finished_bbox_sections.get_lock():
-                finished_bbox_sections.value += 1
             return True
 
         sequence_ids: set[str] = make_sequence_ids_requests(session, tile, global_config)
 
         # Avoids potential partial write issues by writing to a temp file and then as a final operation, then renaming
         # to the real location
-        temp_filename = os.path.join(
-            global_tmp_dir, "_".join([str(c) for c in tile]) + ".pickle"
-        )
-        pickle.dump(sequence_ids, open(temp_filename, "wb"))
-        os.rename(temp_filename, sequence_ids_filename)
-
-        with finished_bbox_sections.get_lock():
-            finished_bbox_sections.value += 1
+        temp_filename = global_tmp_dir_prefix + os.path.basename(sequence_ids_filename)
+        util.dump_pickle(sequence_ids, temp_filename, sync=True)
+        os.replace(temp_filename, sequence_ids_filename)
 
         return True
     except Exception as e:
@@ -298,14 +268,15 @@ def pull_sequence_ids_for_bbox(bbox_section: tuple[int, int, str]) -> bool:
 
 def pull_filter_and_save_trace_for_sequence_ids(
     sequence_id_blocks: tuple[list[str], str]
-) -> None:
+) -> int:
     """
     First, check to see if a sequence ID block already has trace data pulled onto disk. If not, pull it from Mapillary
-    by calling make_trace_data_requests(), filter it using trace_filer.run(), and save it to disk. This is meant to
-    be run in a multi-threaded manner and references global vars made by initialize_multiprocess().
+    by calling make_trace_data_requests(), filter it using trace_filter.is_valid_sequence(), and save it to disk. This
+    is meant to be run in a multi-threaded manner and references global vars made by initialize_globals().
 
     :param sequence_id_blocks: tuple where [0] index: list of sequence IDs to pull traces for, [1] index: the filename
         where the pulled trace data should be stored
+    :return: The number of sequences of the block that were skipped because of filters
     """
     try:
         sequence_id_block, trace_filename = sequence_id_blocks[0], sequence_id_blocks[1]
@@ -313,41 +284,41 @@ def pull_filter_and_save_trace_for_sequence_ids(
 
         # If either we have already pulled trace data to disk, or if it's been pulled AND processed by map_matching,
         # don't pull it again.
-        if os.path.exists(trace_filename) or os.path.exists(processed_trace_filename):
+        if (
+            trace_filename in global_existing_filenames
+            or processed_trace_filename in global_existing_filenames
+        ):
             logging.info(
                 "Traces already exists on disk for sequence_id_block={}. Skipping...".format(
                     sequence_id_block
                 )
             )
-            with finished_bbox_sections.get_lock():
-                finished_bbox_sections.value += 1
-            return
-
-        # We haven't pulled API trace data for this bbox section yet
-        trace_data = make_trace_data_requests(session, sequence_id_block, global_config)
-        before_filter_num_sequences = len(trace_data)
-
-        # Perform some simple filters to weed out bad trace data
-        trace_data = trace_filter.run(trace_data)
-        after_filter_num_sequences = len(trace_data)
-
-        # Check how many sequences were filtered out
-        if after_filter_num_sequences < before_filter_num_sequences:
-            with skipped_sequences_due_to_filters.get_lock():
-                skipped_sequences_due_to_filters.value += (
-                    before_filter_num_sequences - after_filter_num_sequences
-                )
+            return 0
 
         # Avoids potential partial write issues by writing to a temp file and then as a final operation, then renaming
         # to the real location
-        temp_filename = os.path.join(global_tmp_dir, os.path.basename(trace_filename))
-        pickle.dump(trace_data, open(temp_filename, "wb"))
-        os.rename(temp_filename, trace_filename)
-
-        with finished_sequence_id_blocks.get_lock():
-            finished_sequence_id_blocks.value += 1
+        temp_filename = global_tmp_dir_prefix + os.path.basename(trace_filename)
+        num_skipped_sequences = 0
+        with open(temp_filename, "wb", buffering=util.PICKLE_BUFFER_SIZE) as f:
+            with util.compress_trace_file(f) as compressed_f:
+                # We haven't pulled API trace data for this bbox section yet. Each sequence is filtered and written to
+                # disk as soon as it is pulled, so we never hold the trace data for the whole block in memory
+                for sequence in make_trace_data_requests(
+                    session, sequence_id_block, global_config
+                ):
+                    # Sequences with too few images come back as None. Otherwise, perform some simple filters to weed
+                    # out bad trace data
+                    if sequence is not None and trace_filter.is_valid_sequence(sequence):
+                        util.dump_trace_sequences([sequence], compressed_f)
+                    else:
+                        num_skipped_sequences += 1
+            util.sync_file(f)
+        os.replace(temp_filename, trace_filename)
+
+        return num_skipped_sequences
     except Exception as e:
         logging.error("Failed to pull trace data: {}".format(repr(e)))
+        return 0
 
 
 def make_sequence_ids_requests(
@@ -416,15 +387,17 @@ def make_sequence_ids_requests(
 
 def make_trace_data_requests(
     session_: requests.Session, sequence_ids: list[str], conf: any
-) -> list[list[dict]]:
+) -> Iterator[Optional[dict[str, np.ndarray]]]:
     """
-    Makes the calls to the Mapillary API to pull trace data for a given list of sequence IDs.
+    Makes the calls to the Mapillary API to pull trace data for a given list of sequence IDs. The sequences are pulled
+    concurrently by a small pool of threads (the calls are independent and mostly spent waiting on the network), and
+    yielded one at a time in the order of sequence_ids.
 
     :param session_: requests.Session() to persist session across API calls
     :param sequence_ids: List of strings representing Mapillary sequence IDs
     :param conf: Dict of configs. See "--trace-config" section of README for keys
-    :return: List of trace data sequences. Trace data is in format understood by Valhalla map matching process, i.e. it
-        has 'lon', 'lat', 'time', and optionally 'radius' keys
+    :return: Generator of trace data sequences, each a dict of 'time' (epoch seconds), 'lon' and 'lat' float64 arrays,
+        or None if the sequence was skipped because it had too few images
     """
     skip_if_fewer_imgs_than = (
         conf["skip_if_fewer_images_than"]
@@ -432,35 +405,64 @@ def make_trace_data_requests(
         else SKIP_IF_FEWER_IMAGES_THAN_DEFAULT
     )
 
-    sequences = []
-    for sequence_id in sequence_ids:
-        check_rate_limit()  # Check the Mapillary rate limit
-        sequence_resp = session_.get(SEQUENCE_URL.format(sequence_id, access_token))
-        image_ids = [img_id_obj["id"] for img_id_obj in sequence_resp.json()["data"]]
-
-        # Skip sequences that have too few images
-        if len(image_ids) < skip_if_fewer_imgs_than:
-            with skipped_sequences_due_to_filters.get_lock():
-                skipped_sequences_due_to_filters.value += 1
-            continue
-
-        check_rate_limit()  # Check the Mapillary rate limit
-        images_resp = session_.get(IMAGES_URL.format(",".join(image_ids), access_token))
-        images = [
-            {  # Convert to seconds because filtering / map matching assumes time in seconds
-                "time": img_obj["captured_at"] / 1000,
-                "lon": img_obj["geometry"]["coordinates"][0],
-                "lat": img_obj["geometry"]["coordinates"][1],
-            }
-            for img_obj in images_resp.json()["data"]
-        ]
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=SEQUENCE_THREADS_PER_BLOCK
+    ) as executor:
+        make_requests_for_sequence = functools.partial(
+            make_trace_data_requests_for_sequence,
+            session_,
+            skip_if_fewer_imgs_than=skip_if_fewer_imgs_than,
+        )
+        yield from executor.map(make_requests_for_sequence, sequence_ids)
+
+
+def make_trace_data_requests_for_sequence(
+    session_: requests.Session, sequence_id: str, skip_if_fewer_imgs_than: int
+) -> Optional[dict[str, np.ndarray]]:
+    """
+    Makes the calls to the Mapillary API to pull trace data for a single sequence ID.
 
-        # Mapillary returns their trace data in random chronological order, so we need to sort the images
-        images = sorted(images, key=lambda x: x["time"])
+    :param session_: requests.Session() to persist session across API calls
+    :param sequence_id: String representing a Mapillary sequence ID
+    :param skip_if_fewer_imgs_than: Sequences with fewer images than this are skipped
+    :return: The sequence's trace data sorted by time, or None if the sequence was skipped
+    """
+    # The access token is left out of the cache keys, since a new one is obtained on every run
+    check_rate_limit()  # Check the Mapillary rate limit
+    sequence_json, _ = util.get_json_page(
+        session_,
+        SEQUENCE_URL.format(sequence_id, access_token),
+        global_page_cache_dir,
+        cache_key=SEQUENCE_URL.format(sequence_id, ""),
+    )
+    # Skip sequences that have too few images. Checked on the parsed response before we build anything from it
+    if len(sequence_json["data"]) < skip_if_fewer_imgs_than:
+        return None
+    image_ids = ",".join(img_id_obj["id"] for img_id_obj in sequence_json["data"])
 
-        sequences.append(images)
+    check_rate_limit()  # Check the Mapillary rate limit
+    images_json, _ = util.get_json_page(
+        session_,
+        IMAGES_URL.format(image_ids, access_token),
+        global_page_cache_dir,
+        cache_key=IMAGES_URL.format(image_ids, ""),
+    )
+    images = images_json["data"]
+    # Convert to seconds because filtering / map matching assumes time in seconds
+    times = (
+        np.fromiter((img_obj["captured_at"] for img_obj in images), np.float64, len(images))
+        / 1000
+    )
+    lons = np.fromiter(
+        (img_obj["geometry"]["coordinates"][0] for img_obj in images), np.float64, len(images)
+    )
+    lats = np.fromiter(
+        (img_obj["geometry"]["coordinates"][1] for img_obj in images), np.float64, len(images)
+    )
 
-    return sequences
+    # Mapillary returns their trace data in random chronological order, so we need to sort the images
+    order = np.argsort(times, kind="stable")
+    return {"time": times[order], "lon": lons[order], "lat": lats[order]}
 
 
 def find_unique_sequence_ids(
@@ -484,7 +486,7 @@ def find_unique_sequence_ids(
 
     for bbox_section in bbox_sections:
         trace_filename = bbox_section[-1]
-        sequence_ids: set[str] = pickle.load(open(trace_filename, "rb"))
+        sequence_ids: set[str] = util.load_pickle(trace_filename)
         unique_sequence_ids.update(sequence_ids)
         total_sequence_ids_count += len(sequence_ids)
 
@@ -499,12 +501,16 @@ def find_unique_sequence_ids(
     unique_sequence_ids_list: list[str] = list(unique_sequence_ids)
     block_num = 0  # Used for the filename where the traces will be stored
     for i in range(0, len(unique_sequence_ids_list), SEQUENCE_ID_BLOCK_SIZE):
-        trace_filename = os.path.join(traces_dir, "block_{}.pickle".format(block_num))
+        # Sharded so the traces dir doesn't end up with too many files in it
+        trace_filename = util.get_sharded_filename(
+            traces_dir, "block_{}.pickle".format(block_num)
+        )
         block_num += 1
 
         sequence_id_blocks.append(
             (unique_sequence_ids_list[i : i + SEQUENCE_ID_BLOCK_SIZE], trace_filename)
         )
+    util.make_dirs_for_filenames(block[1] for block in sequence_id_blocks)
 
     return sequence_id_blocks
 
@@ -532,7 +538,7 @@ def split_bbox(
 
     try:
         logging.info("Reading bbox_sections from disk...")
-        bbox_sections: list[tuple[int, int, str]] = pickle.load(open(sections_filename, "rb"))
+        bbox_sections: list[tuple[int, int, str]] = util.load_pickle(sections_filename)
     except (OSError, IOError):
         logging.info("bbox_sections pickle not found. Creating and writing to disk...")
         min_lon, min_lat, max_lon, max_lat = [float(s) for s in bbox.split(",")]
@@ -606,7 +612,7 @@ def split_bbox(
         logging.info(
             "Writing bbox_sections with {} z14 tiles to disk...".format(len(bbox_sections))
         )
-        pickle.dump(bbox_sections, open(sections_filename, "wb"))
+        util.dump_pickle(bbox_sections, sections_filename)
 
     return bbox_sections
 
@@ -646,6 +652,12 @@ def z14_tiles_from_coverage_tile_to_bbox_sections(
     """
     found_zoom_14_tiles = []
 
+    # The dir where we will store trace data for each zoom 14 tile, one for this zoom 5 tile. It's kept with a trailing
+    # separator, so each tile's filename is built by appending to it
+    storage_dir_prefix = os.path.join(
+        storage_dir, "_".join([str(COVERAGE_ZOOM), str(x), str(y)]), ""
+    )
+
     for layer in tile_pb.layers:
         # This is how we can traverse data within the protobuf
         keys = [v for v in layer.keys]
@@ -707,17 +719,8 @@ def z14_tiles_from_coverage_tile_to_bbox_sections(
                             candidate_max_lat,
                         ):
                             # The file on disk where we will store trace data, with a dir
-                            storage_filename = os.path.join(
-                                storage_dir,
-                                "_".join([str(COVERAGE_ZOOM), str(x), str(y)]),
-                                "_".join(
-                                    [
-                                        str(BBOX_SECTION_ZOOM),
-                                        str(candidate_x),
-                                        str(candidate_y),
-                                    ]
-                                )
-                                + ".pickle",
+                            storage_filename = storage_dir_prefix + "{}_{}_{}.pickle".format(
+                                BBOX_SECTION_ZOOM, candidate_x, candidate_y
                             )
 
                             zoom_14_tiles_in_bbox.append(
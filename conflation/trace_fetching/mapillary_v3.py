@@ -1,12 +1,13 @@
+import collections
+import concurrent.futures
 import datetime
+import functools
 import logging
-import multiprocessing
+import numpy as np
 import os
-import pickle
 import requests
 from dateutil import parser
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
+from typing import Optional
 
 from conflation import util, trace_filter
 
@@ -23,7 +24,13 @@ SKIP_IF_FEWER_IMAGES_THAN_DEFAULT = (
 )
 SEQUENCE_URL = "https://a.mapillary.com/v3/sequences_without_images?client_id={}&bbox={}&per_page={}&start_date={}"
 IMAGES_URL = "https://a.mapillary.com/v3/images?client_id={}&sequence_keys={}&per_page={}"
-MAX_FILES_IN_DIR = 500  # Maximum number of files we will put in one directory
+# How many sequence keys to pull images for in one API call. Kept small so that a bbox section's image pulls are
+# spread over all of its threads, and the first group can start while the sequences are still being paginated
+SEQUENCE_KEYS_PER_IMAGES_REQUEST = 20
+# The number of threads each bbox section uses to paginate the images of its sequence key groups concurrently
+IMAGE_THREADS_PER_BBOX_SECTION = 4
+# Mapillary's captured_at strings nearly always have this fixed format, i.e. UTC with millisecond precision
+CAPTURED_AT_LENGTH = len("2016-03-14T13:44:37.206Z")
 
 
 def run(bbox: str, traces_dir: str, tmp_dir: str, config: dict, processes: int) -> int:
@@ -35,7 +42,7 @@ def run(bbox: str, traces_dir: str, tmp_dir: str, config: dict, processes: int)
     :param traces_dir: Dir where trace data will be pickled to
     :param tmp_dir: Dir where temp output files will be stored (should be empty upon completion)
     :param config: Dict of configs, see the .README or the conf param of make_trace_data_requests()
-    :param processes: Number of threads to use
+    :param processes: Number of processes requested; util.THREADS_PER_PROCESS threads are used for each of them
     """
     # Do a quick check to see if user specified the mandatory 'client_id' in config JSON
     if "client_id" not in config:
@@ -44,20 +51,32 @@ def run(bbox: str, traces_dir: str, tmp_dir: str, config: dict, processes: int)
     # Break the bbox into sections and save it to a pickle file
     bbox_sections = split_bbox(traces_dir, bbox)
 
-    finished_bbox_sections = multiprocessing.Value("i", 0)
-    with multiprocessing.Pool(
-        initializer=initialize_multiprocess,
-        initargs=(tmp_dir, config, finished_bbox_sections),
-        processes=processes,
-    ) as pool:
-        result = pool.map_async(pull_filter_and_save_trace_for_bbox, bbox_sections)
+    threads = processes * util.THREADS_PER_PROCESS
+    # Each thread keeps paginating the sequences while its image threads are pulling, so it can have one request more
+    # than those in flight at once
+    session = util.make_api_session(threads * (IMAGE_THREADS_PER_BBOX_SECTION + 1))
+
+    pull_filter_and_save = functools.partial(
+        pull_filter_and_save_trace_for_bbox,
+        session_=session,
+        tmp_dir_prefix=os.path.join(tmp_dir, ""),
+        config=config,
+        # Snapshot of the files already in the traces dir, so we can skip finished bbox sections without having to
+        # stat the filesystem for every one of them
+        existing_filenames=util.get_existing_filenames(traces_dir),
+        page_cache_dir=util.get_page_cache_dir(tmp_dir, config),
+    )
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = [executor.submit(pull_filter_and_save, s) for s in bbox_sections]
 
         logging.info("Placing {} results in {}...".format(len(bbox_sections), traces_dir))
         progress = 0
         increment = 5
-        while not result.ready():
-            result.wait(timeout=5)
-            next_progress = int(finished_bbox_sections.value / len(bbox_sections) * 100)
+        # Each completed future is a finished bbox section, so progress is tracked here without any shared counter
+        for finished_bbox_sections, _ in enumerate(
+            concurrent.futures.as_completed(futures), 1
+        ):
+            next_progress = int(finished_bbox_sections / len(bbox_sections) * 100)
             if int(next_progress / increment) > progress:
                 logging.info("Current progress: {}%".format(next_progress))
                 progress = int(next_progress / increment)
@@ -67,61 +86,60 @@ def run(bbox: str, traces_dir: str, tmp_dir: str, config: dict, processes: int)
         return 1
 
 
-def to_bbox_str(llo: float, lla: float, mlo: float, mla: float) -> str:
+def to_bbox_str(llo: str, lla: str, mlo: str, mla: str) -> str:
     """
-    Given (min_lon, min_lat, max_lon, max_lat) bounding box values, returns a string representation understood by
-    Mapillary APIs.
+    Given (min_lon, min_lat, max_lon, max_lat) bounding box values already converted with str(), returns a string
+    representation understood by Mapillary APIs.
     """
-    return ",".join([str(llo), str(lla), str(mlo), str(mla)])
+    return ",".join((llo, lla, mlo, mla))
 
 
-def is_within_bbox(lon: float, lat: float, bbox: list[float]) -> bool:
+def get_section_bounds(min_: float, max_: float, section_size: float) -> list[tuple[str, str]]:
     """
-    Checks if lon / lat coordinate is within a bbox in the format of [min_lon, min_lat, max_lon, max_lat]
+    Splits the [min_, max_] range of a single axis into sections of size section_size, and returns the (lower, upper)
+    bound of each section as strings. Each bound is shared by every bbox section in the same row / column, so we only
+    convert it to a string once.
     """
-    return bbox[0] <= lon < bbox[2] and bbox[1] <= lat < bbox[3]
+    # The lower bounds are computed as min_ + i * section_size rather than by repeatedly adding section_size, so
+    # floating point error doesn't accumulate across sections. The section count is rounded before taking the ceiling,
+    # so float error in the division can neither add a section starting at max_ nor drop the last one
+    section_count = int(np.ceil(round((max_ - min_) / section_size, 9)))
+    lower_bounds = min_ + np.arange(section_count) * section_size
+    upper_bounds = np.minimum(lower_bounds + section_size, max_)
+    return [
+        (str(lower), str(upper))
+        for lower, upper in zip(lower_bounds.tolist(), upper_bounds.tolist())
+    ]
 
 
-def initialize_multiprocess(
-    global_tmp_dir_: str,
-    global_config_: dict,
-    finished_bbox_sections_: multiprocessing.Value,
-) -> None:
+def is_within_bbox(lon: float, lat: float, bbox: list[float]) -> bool:
     """
-    Initializes global variables referenced / updated by all threads of the multiprocess API requests.
+    Checks if lon / lat coordinate is within a bbox in the format of [min_lon, min_lat, max_lon, max_lat]
     """
-    # For persistent connections and timeout settings
-    global session
-    session = requests.Session()
-    retry_strategy = Retry(
-        total=5, status_forcelist=[429, 500, 502, 503, 504], backoff_factor=3
-    )
-    adapter = HTTPAdapter(max_retries=retry_strategy)
-    session.mount("https://", adapter)
-    session.mount("http://", adapter)
-
-    # So each process knows the output / tmp dirs
-    global global_tmp_dir
-    global_tmp_dir = global_tmp_dir_
-
-    # So each process knows the conf provided
-    global global_config
-    global_config = global_config_
-
-    # Integer counter of num of finished bbox_sections
-    global finished_bbox_sections
-    finished_bbox_sections = finished_bbox_sections_
+    return bbox[0] <= lon < bbox[2] and bbox[1] <= lat < bbox[3]
 
 
-def pull_filter_and_save_trace_for_bbox(bbox_section: tuple[str, str]) -> None:
+def pull_filter_and_save_trace_for_bbox(
+    bbox_section: tuple[str, str],
+    session_: requests.Session,
+    tmp_dir_prefix: str,
+    config: dict,
+    existing_filenames: set[str],
+    page_cache_dir: Optional[str] = None,
+) -> None:
     """
     Checks to see if a bbox section already has trace data pulled onto disk. If not, pulls it from Mapillary by calling
     make_trace_data_requests(), filters it using trace_filer.run(), and saves it to disk. Writes to a temp file first
-    to avoid issues if script crashes during the pickle dump. Meant to be run in a multi-threaded manner and references
-    global vars made by initialize_multiprocess().
+    to avoid issues if script crashes during the pickle dump. Meant to be run in a multi-threaded manner.
 
     :param bbox_section: Tuple of (str representation of bbox to feed into Mapillary API, filename where filtered result
         should be stored)
+    :param session_: requests.Session() shared by all threads to persist connections across API calls
+    :param tmp_dir_prefix: Dir where temp output files will be stored, ending in a path separator so that filenames
+        can be appended to it
+    :param config: Dict of configs, see the conf param of make_trace_data_requests()
+    :param existing_filenames: Full filenames of the files that were in the traces dir when the run started
+    :param page_cache_dir: Dir where API responses are cached, or None if they shouldn't be cached
     """
     try:
         bbox, trace_filename = bbox_section
@@ -129,35 +147,36 @@ def pull_filter_and_save_trace_for_bbox(bbox_section: tuple[str, str]) -> None:
 
         # If either we have already pulled trace data to disk, or if it's been pulled AND processed by map_matching,
         # don't pull it again.
-        if os.path.exists(trace_filename) or os.path.exists(processed_trace_filename):
+        if (
+            trace_filename in existing_filenames
+            or processed_trace_filename in existing_filenames
+        ):
             logging.info("Seq already exists on disk for bbox={}. Skipping...".format(bbox))
-            with finished_bbox_sections.get_lock():
-                finished_bbox_sections.value += 1
             return
 
         # We haven't pulled API trace data for this bbox section yet
-        trace_data = make_trace_data_requests(session, bbox, global_config)
-        logging.debug("Before filter: lens: {}".format([len(t) for t in trace_data]))
+        trace_data = make_trace_data_requests(session_, bbox, config, page_cache_dir)
+        logging.debug("Before filter: lens: {}".format([len(t["time"]) for t in trace_data]))
 
         # Perform some simple filters to weed out bad trace data
         trace_data = trace_filter.run(trace_data)
-        logging.debug("After filter: lens: {}".format([len(t) for t in trace_data]))
+        logging.debug("After filter: lens: {}".format([len(t["time"]) for t in trace_data]))
 
         # Avoids potential partial write issues by writing to a temp file and then as a final operation, then renaming
         # to the real location
-        temp_filename = os.path.join(global_tmp_dir, bbox + ".pickle")
-        pickle.dump(trace_data, open(temp_filename, "wb"))
-        os.rename(temp_filename, trace_filename)
-
-        with finished_bbox_sections.get_lock():
-            finished_bbox_sections.value += 1
+        temp_filename = tmp_dir_prefix + bbox + ".pickle"
+        with open(temp_filename, "wb", buffering=util.PICKLE_BUFFER_SIZE) as f:
+            with util.compress_trace_file(f) as compressed_f:
+                util.dump_trace_sequences(trace_data, compressed_f)
+            util.sync_file(f)
+        os.replace(temp_filename, trace_filename)
     except Exception as e:
         logging.error("Failed to pull trace data: {}".format(repr(e)))
 
 
 def make_trace_data_requests(
-    session_: requests.Session, bbox: str, conf: any
-) -> list[list[dict]]:
+    session_: requests.Session, bbox: str, conf: any, page_cache_dir: Optional[str] = None
+) -> list[dict[str, np.ndarray]]:
     """
     Makes the actual calls to Mapillary API to pull trace data for a given bbox string.
 
@@ -165,14 +184,11 @@ def make_trace_data_requests(
     :param bbox: String representation of bbox that Mapillary API understands, i.e. 'min_lon,min_lat,max_lon,max_lat'
     :param conf: Dict of configs. Mandatory keys are ['client_id']. Optional keys are ['sequences_per_page',
         'skip_if_fewer_images_than', 'start_date']
-    :return: List of trace data sequences. Trace data is in format understood by Valhalla map matching process, i.e. it
-        has 'lon', 'lat', 'time', and optionally 'radius' keys
+    :param page_cache_dir: Dir where API responses are cached, or None if they shouldn't be cached
+    :return: List of trace data sequences, each a dict of 'time' (epoch seconds), 'lon' and 'lat' float64 arrays
     """
     bbox_as_list = [float(d) for d in bbox.split(",")]
 
-    # We will use this dict to group trace points by sequence ID
-    sequences_by_id = {}
-
     map_client_id = conf["client_id"]  # The Mapillary client ID, mandatory key of conf
 
     # Check to see if user specified any overrides in conf JSON
@@ -196,93 +212,199 @@ def make_trace_data_requests(
     )
     start_date = conf["start_date"] if "start_date" in conf else SEQUENCE_START_DATE_DEFAULT
 
-    # Paginate sequences within this bbox
-    logging.debug("@ MAPILLARY: Getting seq for bbox={}".format(bbox))
-    seq_next_url = SEQUENCE_URL.format(map_client_id, bbox, seq_per_page, start_date)
-    seq_page = 1
-    while seq_next_url:
-        logging.debug("@@ MAPILLARY: Seq Page {}, url={}".format(seq_page, seq_next_url))
-        seq_resp = session_.get(seq_next_url, timeout=10)
+    # Images are paginated for groups of the collected sequence IDs, to keep the request URLs at a reasonable length.
+    # The groups are independent, so each one is submitted as soon as it's full and its images are pulled while we are
+    # still paginating the sequences
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=IMAGE_THREADS_PER_BBOX_SECTION
+    ) as executor:
+        make_requests_for_group = functools.partial(
+            make_image_requests,
+            session_,
+            map_client_id,
+            img_per_page,
+            page_cache_dir=page_cache_dir,
+        )
+        group_futures = []
+
+        # Paginate sequences within this bbox, collecting the IDs of every sequence we want images for
+        logging.debug("@ MAPILLARY: Getting seq for bbox={}".format(bbox))
+        seq_next_url = SEQUENCE_URL.format(map_client_id, bbox, seq_per_page, start_date)
+        seq_page = 1
         seq_ids = []
-        for seq_f in seq_resp.json()["features"]:
-            seq_id = seq_f["properties"]["key"]
-
-            # If we've already processed this seq_id before, skip it, otherwise we will be writing duplicate image data
-            if seq_id in sequences_by_id:
-                logging.debug(
-                    "@@@ MAPILLARY: Skipping seq_id={} b/c we've already seen it on a previous page".format(
-                        seq_id
+        seen_seq_ids = set()
+        while seq_next_url:
+            logging.debug("@@ MAPILLARY: Seq Page {}, url={}".format(seq_page, seq_next_url))
+            # The next URL tells us if there is a next sequence page or if we are finished with this bbox
+            seq_page_json, seq_next_url = util.get_json_page(
+                session_, seq_next_url, page_cache_dir, timeout=10
+            )
+            for seq_f in seq_page_json["features"]:
+                seq_id = seq_f["properties"]["key"]
+
+                # If we've already seen this seq_id before, skip it, otherwise we will be writing duplicate image data
+                if seq_id in seen_seq_ids:
+                    logging.debug(
+                        "@@@ MAPILLARY: Skipping seq_id={} b/c we've already seen it on a previous page".format(
+                            seq_id
+                        )
                     )
-                )
-                continue
-
-            # Only process sequences that originated from this bbox. This prevents us from processing sequences twice
-            origin_lon, origin_lat = seq_f["geometry"]["coordinates"][0]
-            if not is_within_bbox(origin_lon, origin_lat, bbox_as_list):
-                logging.debug(
-                    "@@@ MAPILLARY: Skipping seq b/c origin ({}, {}) not in bbox {}".format(
-                        origin_lon, origin_lat, bbox
+                    continue
+
+                coordinates = seq_f["geometry"]["coordinates"]
+
+                # Skip sequences that have too few images. Checked before the bbox test since it's just a length lookup
+                if len(coordinates) < skip_if_fewer_imgs_than:
+                    continue
+
+                # Only process sequences that originated from this bbox. This prevents us from processing sequences
+                # twice
+                origin_lon, origin_lat = coordinates[0]
+                if not is_within_bbox(origin_lon, origin_lat, bbox_as_list):
+                    logging.debug(
+                        "@@@ MAPILLARY: Skipping seq b/c origin ({}, {}) not in bbox {}".format(
+                            origin_lon, origin_lat, bbox
+                        )
                     )
-                )
-                continue
-
-            # Skip sequences that have too few images
-            if len(seq_f["geometry"]["coordinates"]) < skip_if_fewer_imgs_than:
-                continue
-
-            seq_ids.append(seq_id)
-
-        if len(seq_ids) > 0:
-            # Paginate images within these sequences
-            img_next_url = IMAGES_URL.format(map_client_id, ",".join(seq_ids), img_per_page)
-            img_page = 1
-            while img_next_url:
-                logging.debug(
-                    "@@@ MAPILLARY: Image Page {}, url={}".format(img_page, img_next_url)
-                )
-                img_resp = session_.get(img_next_url, timeout=10)
-                for img_f in img_resp.json()["features"]:
-                    if img_f["properties"]["sequence_key"] not in sequences_by_id:
-                        sequences_by_id[img_f["properties"]["sequence_key"]] = []
-                    sequences_by_id[img_f["properties"]["sequence_key"]].append(
-                        {
-                            "time": parser.isoparse(
-                                img_f["properties"]["captured_at"]
-                            ).timestamp(),  # Epoch time
-                            "lon": img_f["geometry"]["coordinates"][0],
-                            "lat": img_f["geometry"]["coordinates"][1],
-                        }
+                    continue
+
+                seq_ids.append(seq_id)
+                seen_seq_ids.add(seq_id)
+                if len(seq_ids) % SEQUENCE_KEYS_PER_IMAGES_REQUEST == 0:
+                    group_futures.append(
+                        executor.submit(
+                            make_requests_for_group,
+                            seq_ids[-SEQUENCE_KEYS_PER_IMAGES_REQUEST:],
+                        )
                     )
 
-                # Check if there is a next image page or if we are finished with this sequence
-                img_next_url = (
-                    img_resp.links["next"]["url"] if "next" in img_resp.links else None
+            # Already collected enough sequences. Move onto pulling their images
+            if len(seq_ids) > max_sequences_per_bbox_section:
+                logging.info(
+                    "Already collected {} seqs for this bbox section, greater than max_sequences_per_bbox_section={}. "
+                    "Continuing...".format(len(seq_ids), max_sequences_per_bbox_section)
+                )
+                break
+
+            seq_page += 1
+
+        # Submit the last, partially filled group. We will use this dict to group trace points by sequence ID; a
+        # sequence only ever belongs to a single group
+        sequences_by_id = {}
+        if len(seq_ids) % SEQUENCE_KEYS_PER_IMAGES_REQUEST:
+            group_futures.append(
+                executor.submit(
+                    make_requests_for_group,
+                    seq_ids[-(len(seq_ids) % SEQUENCE_KEYS_PER_IMAGES_REQUEST) :],
                 )
-                img_page += 1
-
-        # Already collected enough sequences. Move onto the next bbox section
-        if len(sequences_by_id) > max_sequences_per_bbox_section:
-            logging.info(
-                "Already collected {} seqs for this bbox section, greater than max_sequences_per_bbox_section={}. "
-                "Continuing...".format(len(sequences_by_id), max_sequences_per_bbox_section)
             )
-            break
-
-        # Check if there is a next sequence page or if we are finished with this bbox
-        seq_next_url = seq_resp.links["next"]["url"] if "next" in seq_resp.links else None
-        seq_page += 1
+        for future in group_futures:
+            sequences_by_id.update(future.result())
 
     logging.debug("Keys: {}".format(list(sequences_by_id.keys())))
 
     # We don't care about the sequence IDs anymore (just using it as a method to group trace data), so we just return
-    # values
-    sequences = list(sequences_by_id.values())
+    # values. Mapillary returns their trace data in reverse chronological order (latest image first), so we reverse
+    # that back to get the order the images were taken, which is what map matching needs
+    return [
+        {
+            "time": parse_captured_at_array(captured_ats[::-1]),  # Epoch time
+            "lon": np.array(lons[::-1], dtype=np.float64),
+            "lat": np.array(lats[::-1], dtype=np.float64),
+        }
+        for captured_ats, lons, lats in sequences_by_id.values()
+    ]
+
+
+def make_image_requests(
+    session_: requests.Session,
+    map_client_id: str,
+    img_per_page: int,
+    seq_ids: list[str],
+    page_cache_dir: Optional[str] = None,
+) -> dict[str, tuple[list[str], list[float], list[float]]]:
+    """
+    Paginates the Mapillary images API for a single group of sequence keys. Only the fields we need are kept from each
+    page as soon as it is parsed, so we never hold more than one page of GeoJSON features in memory.
+
+    :param session_: requests.Session() to persist session across API calls
+    :param map_client_id: The Mapillary client ID
+    :param img_per_page: How many images to receive on each page of the API call
+    :param seq_ids: The sequence keys to pull images for
+    :param page_cache_dir: Dir where API responses are cached, or None if they shouldn't be cached
+    :return: Dict of sequence key -> (captured_at strings, lons, lats) of its images, in the order Mapillary returned
+        them
+    """
+    # Each sequence accumulates its columns as lists, which are converted to arrays once all the images are pulled
+    sequences_by_id = collections.defaultdict(lambda: ([], [], []))
+    img_next_url = IMAGES_URL.format(map_client_id, ",".join(seq_ids), img_per_page)
+    img_page = 1
+    while img_next_url:
+        logging.debug("@@@ MAPILLARY: Image Page {}, url={}".format(img_page, img_next_url))
+        # The next URL tells us if there is a next image page or if we are finished with these sequences
+        img_page_json, img_next_url = util.get_json_page(
+            session_, img_next_url, page_cache_dir, timeout=10
+        )
+        for img_f in img_page_json["features"]:
+            captured_ats, lons, lats = sequences_by_id[img_f["properties"]["sequence_key"]]
+            captured_ats.append(img_f["properties"]["captured_at"])
+            lons.append(img_f["geometry"]["coordinates"][0])
+            lats.append(img_f["geometry"]["coordinates"][1])
+        img_page += 1
+
+    return sequences_by_id
+
+
+def parse_captured_at(captured_at: str) -> float:
+    """
+    Converts the ISO 8601 'captured_at' string of a Mapillary image (e.g. '2016-03-14T13:44:37.206Z') into an epoch
+    timestamp in seconds.
+    """
+    # datetime.fromisoformat is a C routine and much faster than dateutil's isoparse, but it only accepts the trailing
+    # 'Z' from Python 3.11 onwards, so we swap it for the equivalent UTC offset
+    try:
+        return datetime.datetime.fromisoformat(captured_at.replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        # Fall back to the slower but more lenient dateutil parser for anything non-standard
+        return parser.isoparse(captured_at).timestamp()
 
-    # Mapillary returns their trace data in reverse chronological order (latest image first), so we reverse that
-    # back to get the order the images were taken, which is what map matching needs
-    [s.reverse() for s in sequences]
 
-    return sequences
+def parse_captured_at_array(captured_ats: list[str]) -> np.ndarray:
+    """
+    Vectorized version of parse_captured_at(), converting all the 'captured_at' strings of a sequence into a float64
+    array of epoch timestamps in seconds with a single numpy datetime64 parse.
+    """
+    captured_ats = np.array(captured_ats, dtype=str)
+    # numpy's datetime64 has no notion of timezones, so it can only take the UTC timestamps (with the trailing 'Z'
+    # stripped) that Mapillary normally returns. Anything else goes through the scalar parser
+    if (
+        captured_ats.dtype.itemsize == CAPTURED_AT_LENGTH * 4
+        and (
+            captured_ats.view(np.uint32)[CAPTURED_AT_LENGTH - 1 :: CAPTURED_AT_LENGTH]
+            == ord("Z")
+        ).all()
+    ):
+        # Fast path for the fixed format: numpy pads every string to the longest one, so if they are all exactly
+        # CAPTURED_AT_LENGTH long and end in 'Z' (checked on the raw UCS4 code points, without a string op per
+        # element), casting to one char shorter drops the 'Z'
+        utc_captured_ats = captured_ats.astype("U{}".format(CAPTURED_AT_LENGTH - 1))
+    elif np.char.endswith(captured_ats, "Z").all():
+        utc_captured_ats = np.char.rstrip(captured_ats, "Z")
+    else:
+        utc_captured_ats = None
+
+    if utc_captured_ats is not None:
+        try:
+            # Parsed at microsecond precision like the scalar parser, so any sub-millisecond digits aren't truncated
+            return utc_captured_ats.astype("datetime64[us]").astype(np.int64) / 1000000
+        except ValueError:
+            # numpy is stricter than the scalar parser (e.g. it rejects an hour of 24), so those go through it as well
+            pass
+    # Images taken in bursts share the same captured_at, so each distinct string only needs to be parsed once
+    unique_captured_ats, inverse = np.unique(captured_ats, return_inverse=True)
+    return np.array(
+        [parse_captured_at(c) for c in unique_captured_ats.tolist()], dtype=np.float64
+    )[inverse]
 
 
 def split_bbox(
@@ -305,7 +427,7 @@ def split_bbox(
 
     try:
         logging.info("Reading bbox_sections from disk...")
-        bbox_sections: list[tuple[str, str]] = pickle.load(open(sections_filename, "rb"))
+        bbox_sections: list[tuple[str, str]] = util.load_pickle(sections_filename)
     except (OSError, IOError):
         logging.info("bbox_sections pickle not found. Creating and writing to disk...")
         min_long, min_lat, max_long, max_lat = [float(s) for s in bbox.split(",")]
@@ -327,37 +449,24 @@ def split_bbox(
             ((max_long - min_long) // section_size + 1)
             * ((max_lat - min_lat) // section_size + 1)
         )
-        if num_files > MAX_FILES_IN_DIR:
-            # TODO: Split up the bbox sections further into 'pages', and use these as different dirs to put output
-            #  in, that way we won't ever have too many files in one dir
-            logging.warning(
-                "{} bbox sections will be generated and a .pickle file will be created for all of them, "
-                "violating the MAX_FILES_IN_DIR={}".format(num_files, MAX_FILES_IN_DIR)
-            )
-        else:
-            logging.info("{} bbox sections will be generated...".format(num_files))
+        logging.info("{} bbox sections will be generated...".format(num_files))
 
         bbox_sections = []
-        prev_long = min_long
-        while prev_long < max_long:
-            cur_long = min(prev_long + section_size, max_long)
-            prev_lat = min_lat
-            while prev_lat < max_lat:
-                cur_lat = min(prev_lat + section_size, max_lat)
-
-                # Convert the long / lat bbox bounds to a string that the trace source API can understand (using the
-                # given lambda)
+        lat_bounds = get_section_bounds(min_lat, max_lat, section_size)
+        for prev_long, cur_long in get_section_bounds(min_long, max_long, section_size):
+            for prev_lat, cur_lat in lat_bounds:
+                # Convert the long / lat bbox bounds to a string that the trace source API can understand
                 bbox_str = to_bbox_str(prev_long, prev_lat, cur_long, cur_lat)
 
-                # The file on disk where we will store trace data
-                trace_filename = os.path.join(
+                # The file on disk where we will store trace data, sharded so the traces dir doesn't end up with too
+                # many files in it
+                trace_filename = util.get_sharded_filename(
                     traces_dir, util.get_sha1_truncated_id(bbox_str) + ".pickle"
                 )
 
                 bbox_sections.append((bbox_str, trace_filename))
-                prev_lat += section_size
-            prev_long += section_size
 
-        pickle.dump(bbox_sections, open(sections_filename, "wb"))
+        util.make_dirs_for_filenames(s[1] for s in bbox_sections)
+        util.dump_pickle(bbox_sections, sections_filename)
 
     return bbox_sections
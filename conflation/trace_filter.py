@@ -1,6 +1,5 @@
 import logging
 import numpy as np
-from math import radians, cos, sin, asin, sqrt
 
 # Configurable constants for filtering
 MINIMUM_MEAN_SPEED = 10  # km / h
@@ -13,11 +12,22 @@ MAXIMUM_SPEED_BETWEEN_ADJACENT_POINTS = 160  # km / h, to weed out poor measurem
 MAXIMUM_POOR_MEASUREMENTS_PERCENT = (
     0.25  # 25%, max %age of traces that are marked as poor measurements
 )
+EARTH_RADIUS = 6378160  # meters
 
 
-def run(trace_data: list[list[dict]]) -> list[list[dict]]:
+def run(trace_data: list[dict[str, np.ndarray]]) -> list[dict[str, np.ndarray]]:
     """
-    Performs simple filters on trace_data. A list of trace data will only be accepted if:
+    Performs simple filters on trace_data, keeping only the sequences accepted by is_valid_sequence().
+
+    :param trace_data: List of trace sequences, where each sequence is a dict of 'time', 'lon' and 'lat' arrays
+    :return: Filtered list of trace sequences using the same format
+    """
+    return [sequence for sequence in trace_data if is_valid_sequence(sequence)]
+
+
+def is_valid_sequence(sequence: dict[str, np.ndarray]) -> bool:
+    """
+    Performs simple filters on a single sequence of traces. The sequence will only be accepted if:
     - Total time of sequence exceeds MINIMUM_TOTAL_TIME
     - There are no out-of-order timestamps, i.e. all points are sequential
     - If time between adjacent points is too long, i.e. adjacent time deltas more than
@@ -28,106 +38,77 @@ def run(trace_data: list[list[dict]]) -> list[list[dict]]:
     - Total distance of sequence exceeds MINIMUM_TOTAL_DISTANCE
     - Mean speed is above the walking / driving threshold, MINIMUM_MEAN_SPEED
 
-    :param trace_data: List of sequence of traces, where each trace should be dict objects with the same format used by
-        the Valhalla map matching API, i.e. it should have 'lon', 'lat', 'time', and optionally 'radius' keys
-    :return: Filtered list of trace sequences using the same dict object format
+    :param sequence: Sequence of traces, as a dict of 'time' (epoch seconds), 'lon' and 'lat' arrays
+    :return: True if the sequence passes all the filters
     """
-    filtered_trace_data = []
-    for sequence in trace_data:
-        speeds = []
-
-        # Skip if time spent on sequence isn't long enough
-        if sequence[-1]["time"] - sequence[0]["time"] < MINIMUM_TOTAL_TIME:
-            logging.debug(
-                "Skipping trace b/c min time {}".format(
-                    sequence[-1]["time"] - sequence[0]["time"]
-                )
-            )
-            continue
-
-        total_dist = 0  # meters
-        # Number of traces that we mark as being measurements as per MAXIMUM_TIME_BETWEEN_ADJACENT_POINTS and
-        # MAXIMUM_SPEED_BETWEEN_ADJACENT_POINTS
-        num_poor_measurements = 0
-
-        # A boolean flag that allows us to signal bad sequences from within the following for loop
-        should_skip_sequence = False
-        for i in range(len(sequence) - 1):
-            from_timestamp, from_lon, from_lat = (
-                sequence[i]["time"],
-                sequence[i]["lon"],
-                sequence[i]["lat"],
-            )
-            to_timestamp, to_lon, to_lat = (
-                sequence[i + 1]["time"],
-                sequence[i + 1]["lon"],
-                sequence[i + 1]["lat"],
-            )
-            d = haversine(from_lon, from_lat, to_lon, to_lat)  # Meters
-            t = to_timestamp - from_timestamp
-
-            # It's essential for us to submit traces in order for map matching, so if a trace's timestamp is less
-            # than a previous trace's timestamp, something is wrong with this sequence so we will throw it away to
-            # be safe
-            if t < 0:
-                logging.debug("Skipping trace b/c min time < 0")
-                should_skip_sequence = True
-
-            # Skip calculating speed for this specific trace point if no time elapsed
-            if t == 0:
-                continue
-
-            # Adjacent points should not have too large of a time gap
-            if t > MAXIMUM_TIME_BETWEEN_ADJACENT_POINTS:
-                num_poor_measurements += 1
-
-            total_dist += d
-            v_kmph = d / 1000 / t * 3600  # km / h
-
-            # Should not be going crazy fast between adjacent points
-            if v_kmph > MAXIMUM_SPEED_BETWEEN_ADJACENT_POINTS:
-                num_poor_measurements += 1
-
-            speeds.append(v_kmph)
-
-        if should_skip_sequence:
-            logging.debug("Skipping trace b/c should skip seq")
-            continue
-
-        if num_poor_measurements / len(sequence) > MAXIMUM_POOR_MEASUREMENTS_PERCENT:
-            logging.debug(
-                "Skipping trace b/c too many latent traces {}".format(num_poor_measurements)
-            )
-            continue
-
-        # Skip if distance traveled on sequence isn't long enough
-        if total_dist < MINIMUM_TOTAL_DISTANCE:
-            logging.debug("Skipping trace b/c min total dist {}".format(total_dist))
-            continue
-
-        # Skip if we feel like the average speed in this sequence isn't fast enough correspond with someone driving
-        if np.array(speeds).mean() < MINIMUM_MEAN_SPEED:
-            logging.debug("Skipping trace b/c mean speed {}".format(np.array(speeds).mean()))
-            continue
-
-        filtered_trace_data.append(sequence)
-
-    return filtered_trace_data
-
-
-def haversine(lon1: float, lat1: float, lon2: float, lat2: float) -> float:
+    times, lons, lats = sequence["time"], sequence["lon"], sequence["lat"]
+
+    # Skip if time spent on sequence isn't long enough
+    if times[-1] - times[0] < MINIMUM_TOTAL_TIME:
+        logging.debug("Skipping trace b/c min time {}".format(times[-1] - times[0]))
+        return False
+
+    # All the checks between adjacent points are done at once on arrays with one element per pair of points
+    ts = np.diff(times)  # Seconds
+
+    # It's essential for us to submit traces in order for map matching, so if a trace's timestamp is less than a
+    # previous trace's timestamp, something is wrong with this sequence so we will throw it away to be safe
+    if (ts < 0).any():
+        logging.debug("Skipping trace b/c min time < 0")
+        return False
+
+    # Skip calculating speed for pairs of points where no time elapsed
+    is_moving = ts != 0
+    ts = ts[is_moving]
+
+    # Number of traces that we mark as being poor measurements. Adjacent points should not have too large of a time
+    # gap, which is cheap to check, so if that alone is too many we skip the sequence before computing any distances
+    num_poor_measurements = np.count_nonzero(ts > MAXIMUM_TIME_BETWEEN_ADJACENT_POINTS)
+    if num_poor_measurements / len(times) > MAXIMUM_POOR_MEASUREMENTS_PERCENT:
+        logging.debug(
+            "Skipping trace b/c too many latent traces {}".format(num_poor_measurements)
+        )
+        return False
+
+    ds = get_adjacent_distances(lons, lats)[is_moving]  # Meters
+    speeds = ds / 1000 / ts * 3600  # km / h
+
+    # Adjacent points should also not be going crazy fast between them
+    num_poor_measurements += np.count_nonzero(speeds > MAXIMUM_SPEED_BETWEEN_ADJACENT_POINTS)
+    if num_poor_measurements / len(times) > MAXIMUM_POOR_MEASUREMENTS_PERCENT:
+        logging.debug(
+            "Skipping trace b/c too many latent traces {}".format(num_poor_measurements)
+        )
+        return False
+
+    # Skip if distance traveled on sequence isn't long enough
+    total_dist = ds.sum()  # Meters
+    if total_dist < MINIMUM_TOTAL_DISTANCE:
+        logging.debug("Skipping trace b/c min total dist {}".format(total_dist))
+        return False
+
+    # Skip if we feel like the average speed in this sequence isn't fast enough correspond with someone driving
+    mean_speed = speeds.mean()  # km / h
+    if mean_speed < MINIMUM_MEAN_SPEED:
+        logging.debug("Skipping trace b/c mean speed {}".format(mean_speed))
+        return False
+
+    return True
+
+
+def get_adjacent_distances(lons: np.ndarray, lats: np.ndarray) -> np.ndarray:
     """
-    Calculate the great circle distance between two points on the earth (specified in decimal degrees).
+    Calculate the great circle distance (haversine formula) between each pair of adjacent points of a sequence
+    (specified in decimal degrees). Every point is part of two pairs, so its conversion to radians and the cosine of its
+    latitude are only computed once.
 
-    :return: Distance in meters
+    :return: Distances in meters, one less than the number of points
     """
-    # convert decimal degrees to radians
-    lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
-
-    # haversine formula
-    dlon = lon2 - lon1
-    dlat = lat2 - lat1
-    a = sin(dlat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(dlon / 2) ** 2
-    c = 2 * asin(sqrt(a))
-    r = 6378160  # Radius of earth in meters.
-    return c * r
+    lons, lats = np.radians(lons), np.radians(lats)
+    cos_lats = np.cos(lats)
+    a = (
+        np.sin(np.diff(lats) / 2) ** 2
+        + cos_lats[:-1] * cos_lats[1:] * np.sin(np.diff(lons) / 2) ** 2
+    )
+    c = 2 * np.arcsin(np.sqrt(a))
+    return c * EARTH_RADIUS
@@ -1,6 +1,21 @@
+import gzip
 import hashlib
+import json
+import mmap
+import numpy as np
 import os
+import pickle
+import requests
 import uuid
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from typing import BinaryIO, Iterable, Iterator, Optional
+
+# orjson is an optional dependency that parses JSON several times faster than the standard library
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 OUTPUT_DIR = "output"
 TRACES_DIR = "traces"
@@ -9,8 +24,31 @@ MAP_MATCH_DIR = "map_matches"
 RESULTS_DIR = "results"
 SECTIONS_PICKLE_FILENAME = "sections.pickle"
 PROCESSED_TRACE_EXTENSION = ".processed"
+TEMP_FILE_EXTENSION = (
+    ".tmp"  # For files that are written in place before being renamed to their real name
+)
 FINAL_RESULTS_FILENAME = "config.json"
 MAP_MATCH_REGION_FILENAME_DELIMITER = "-"
+PAGE_CACHE_DIR_NAME = (
+    "page_cache"  # Name of the dir under the tmp dir where API responses can be cached
+)
+# Trace files are spread over 16^SHARD_ID_LENGTH subdirs, so no single dir ends up with too many files
+SHARD_ID_LENGTH = 2
+# Trace sequences are passed around as a dict of one numpy array per column, rather than a list of per-point dicts
+TRACE_COLUMNS = ("time", "lon", "lat")
+# Coordinates are stored in the trace pickles as int32 multiples of 1e-7 degrees (about a centimeter), which halves
+# their size compared to float64 without losing any precision that GPS traces actually have
+TRACE_COORDINATE_COLUMNS = ("lon", "lat")
+TRACE_COORDINATE_SCALE = 10**7
+# Protocol 5 (PEP 574) is the fastest / most compact pickle protocol, and pickles numpy arrays as raw contiguous
+# buffers instead of going through their reduce methods
+PICKLE_PROTOCOL = 5
+# Trace files are gzipped at the lowest level, which already gets most of the size reduction for a fraction of the CPU
+TRACE_COMPRESSION_LEVEL = 1
+GZIP_MAGIC = b"\x1f\x8b"  # The first two bytes of any gzip file
+PICKLE_BUFFER_SIZE = (
+    1 << 20
+)  # Size of the file buffer used when reading / writing pickles, in bytes
 
 
 def initialize_dirs(bbox_str: str) -> tuple[str, str, str, str, str]:
@@ -29,6 +67,8 @@ def initialize_dirs(bbox_str: str) -> tuple[str, str, str, str, str]:
         )
     )
     traces_dir = os.path.join(os.getcwd(), OUTPUT_DIR, bbox, TRACES_DIR)
+    # Temp files are renamed into the other dirs once written, which is only atomic within a filesystem, so the tmp dir
+    # always lives next to them
     tmp_dir = os.path.join(os.getcwd(), OUTPUT_DIR, bbox, TEMP_DIR)
     map_matches_dir = os.path.join(os.getcwd(), OUTPUT_DIR, bbox, MAP_MATCH_DIR)
     results_dir = os.path.join(os.getcwd(), OUTPUT_DIR, bbox, RESULTS_DIR)
@@ -47,6 +87,116 @@ def initialize_dirs(bbox_str: str) -> tuple[str, str, str, str, str]:
     return traces_dir, tmp_dir, map_matches_dir, results_dir, log_filename
 
 
+def load_json(resp: requests.Response) -> any:
+    """
+    Returns the parsed JSON body of an API response. Uses orjson straight on the response bytes if it is installed,
+    otherwise falls back to resp.json().
+    """
+    if orjson is not None:
+        return orjson.loads(resp.content)
+    return resp.json()
+
+
+# Pulling trace data is dominated by waiting on the API, so the trace fetchers run this many threads per requested
+# process, all sharing one make_api_session() session. The resulting number of concurrent requests is documented under
+# --concurrency in the README, so keep it in sync
+THREADS_PER_PROCESS = 8
+
+
+def make_api_session(pool_maxsize: int, retry_posts: bool = False) -> requests.Session:
+    """
+    Creates a requests.Session() to be shared by all threads making calls to an API. Failed calls (rate limiting,
+    server errors) are retried with backoff, and the connection pool is sized so that every thread can keep its own
+    connection open rather than having to reconnect.
+
+    :param pool_maxsize: Max number of connections the session keeps open, i.e. the number of threads sharing it
+    :param retry_posts: Whether POSTs should be retried as well. Only safe if the API's POSTs are idempotent
+    :return: The session
+    """
+    session = requests.Session()
+    retry_strategy = Retry(
+        total=5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        backoff_factor=3,
+        allowed_methods=(
+            Retry.DEFAULT_ALLOWED_METHODS | {"POST"}
+            if retry_posts
+            else Retry.DEFAULT_ALLOWED_METHODS
+        ),
+    )
+    adapter = HTTPAdapter(max_retries=retry_strategy, pool_maxsize=pool_maxsize)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_json_page(
+    session_: requests.Session,
+    url: str,
+    page_cache_dir: Optional[str] = None,
+    cache_key: Optional[str] = None,
+    timeout: Optional[float] = None,
+) -> tuple[any, Optional[str]]:
+    """
+    GETs a page of a JSON API, and returns its parsed body along with the URL of the next page given by its Link header
+    (None if it's the last page). If page_cache_dir is given, successful responses are cached on disk so that a rerun
+    doesn't have to pull the same pages from the API again.
+
+    :param session_: requests.Session() to persist session across API calls
+    :param url: URL of the page
+    :param page_cache_dir: Dir where responses are cached, or None to always make the API call
+    :param cache_key: What identifies the page in the cache, by default the URL itself. Should be given if the URL
+        contains values that can change between runs for the same page, e.g. access tokens
+    :param timeout: Timeout of the API call in seconds
+    :return: Tuple of (parsed JSON body, URL of the next page or None)
+    """
+    if page_cache_dir is None:
+        resp = session_.get(url, timeout=timeout)
+        return load_json(resp), resp.links["next"]["url"] if "next" in resp.links else None
+
+    # Responses are stored under two levels of dirs, so no single dir ends up with too many files
+    key = hashlib.sha256(
+        (cache_key if cache_key is not None else url).encode("UTF-8")
+    ).hexdigest()
+    cache_filename = os.path.join(page_cache_dir, key[:2], key + ".pickle")
+    try:
+        content, next_url = load_pickle(cache_filename)
+    except (OSError, IOError, ValueError, EOFError, pickle.UnpicklingError):
+        # Besides a missing entry, this also catches an empty or truncated one (e.g. left by a crash), which is pulled
+        # again and overwritten rather than failing the page on every rerun
+        resp = session_.get(url, timeout=timeout)
+        content = resp.content
+        next_url = resp.links["next"]["url"] if "next" in resp.links else None
+        if resp.status_code == 200:
+            # Same temp file + rename pattern as the other outputs, with a unique temp name since several threads can
+            # pull the same page at once. Unlike them, the entry isn't synced: one left empty or truncated by a crash
+            # fails to load above, and is then simply pulled again
+            os.makedirs(os.path.dirname(cache_filename), exist_ok=True)
+            temp_filename = cache_filename + "." + uuid.uuid4().hex[:8]
+            dump_pickle((content, next_url), temp_filename)
+            os.replace(temp_filename, cache_filename)
+
+    return parse_json(content), next_url
+
+
+def parse_json(content: any) -> any:
+    """
+    Parses a JSON document given as bytes or str. Uses orjson if it is installed, otherwise falls back to json.loads().
+    """
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def dump_json(obj: any) -> bytes:
+    """
+    Serializes obj into a JSON request body. Uses orjson if it is installed, otherwise falls back to json.dumps().
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode("UTF-8")
+
+
 def get_sha1_truncated_id(s: str) -> str:
     """
     Return a truncated hash of any given string. Used on bbox and bbox sections to keep track of duplicate runs / work
@@ -63,6 +213,18 @@ def get_sections_filename(traces_dir_: str) -> str:
     return os.path.join(traces_dir_, SECTIONS_PICKLE_FILENAME)
 
 
+def get_page_cache_dir(tmp_dir_: str, conf: dict) -> Optional[str]:
+    """
+    Returns the dir where API responses should be cached given the `cache_pages` conf, or None if they shouldn't be
+    cached. A path can be given instead of `true`, so that the cache is kept and shared across runs (e.g. with slightly
+    different bboxes) rather than living under the run's own tmp dir, which is deleted once the run completes.
+    """
+    cache_pages = conf["cache_pages"] if "cache_pages" in conf else False
+    if isinstance(cache_pages, str):
+        return cache_pages
+    return os.path.join(tmp_dir_, PAGE_CACHE_DIR_NAME) if cache_pages else None
+
+
 def get_processed_trace_filename(trace_filename: str) -> str:
     """
     Returns the full filename of the trace pickle, if it has already been processed by a map matching script.
@@ -70,6 +232,133 @@ def get_processed_trace_filename(trace_filename: str) -> str:
     return trace_filename + PROCESSED_TRACE_EXTENSION
 
 
+def get_sharded_filename(dir_: str, name: str) -> str:
+    """
+    Returns the full filename of the file called name, placed in a subdir of dir_ picked by a hash of name (see
+    make_dirs_for_filenames() to create the subdirs). Lookups stay fast even when a run has many thousands of files.
+    """
+    return os.path.join(dir_, get_sha1_truncated_id(name)[:SHARD_ID_LENGTH], name)
+
+
+def make_dirs_for_filenames(filenames: Iterable[str]) -> None:
+    """
+    Creates the (shard) dirs that the given full filenames are in, if they don't exist yet.
+    """
+    for dir_ in {os.path.dirname(filename) for filename in filenames}:
+        os.makedirs(dir_, exist_ok=True)
+
+
+def get_existing_filenames(dir_: str) -> set[str]:
+    """
+    Returns the full filenames of every file currently in dir_ or any of its (shard) subdirs. Lets the multiprocess
+    steps check which bbox sections were already completed by a previous run with a single walk of the dir, instead of
+    a stat call per section.
+    """
+    return {
+        os.path.join(subdir, filename)
+        for subdir, _, filenames in os.walk(dir_)
+        for filename in filenames
+    }
+
+
+def dump_pickle(obj: any, filename: str, sync: bool = False) -> None:
+    """
+    Pickles obj to filename using PICKLE_PROTOCOL and a large file buffer. If sync is given, the file is synced to disk
+    with sync_file() once written.
+    """
+    with open(filename, "wb", buffering=PICKLE_BUFFER_SIZE) as f:
+        pickle.dump(obj, f, protocol=PICKLE_PROTOCOL)
+        if sync:
+            sync_file(f)
+
+
+def sync_file(f: BinaryIO) -> None:
+    """
+    Flushes the open file f and fsyncs it. Temp files should be synced before being renamed to their real location, as
+    otherwise a crash right after the rename can leave a file there that is empty or truncated, which later steps would
+    then take as finished.
+    """
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def load_pickle(filename: str) -> any:
+    """
+    Reads back an object pickled by dump_pickle() (or any other single-object pickle). The file is mapped into memory
+    and unpickled straight from there, rather than being copied in through a read buffer.
+    """
+    with open(filename, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        return pickle.loads(m)
+
+
+def dump_trace_sequences(sequences: Iterable[dict[str, np.ndarray]], f: BinaryIO) -> None:
+    """
+    Writes trace sequences to the open file f, pickling each sequence on its own as it comes in. This means a generator
+    of sequences can be written out without ever holding all of them in memory at once.
+
+    Each sequence is a dict of one float64 array per key of TRACE_COLUMNS, which is several times smaller on disk and
+    much faster to pickle than a list of dicts.
+    """
+    for sequence in sequences:
+        pickle.dump(quantize_columns(sequence), f, protocol=PICKLE_PROTOCOL)
+
+
+def compress_trace_file(f: BinaryIO) -> gzip.GzipFile:
+    """
+    Wraps the open file f so that trace sequences dumped into it are gzipped with TRACE_COMPRESSION_LEVEL. Closing the
+    returned file finishes the gzip stream but leaves f open, so it can still be synced before being renamed.
+    """
+    return gzip.GzipFile(fileobj=f, mode="wb", compresslevel=TRACE_COMPRESSION_LEVEL, mtime=0)
+
+
+def load_trace_sequences(trace_filename: str) -> Iterator[dict[str, np.ndarray]]:
+    """
+    Reads back the trace sequences written by dump_trace_sequences(), one sequence at a time. The file can either be
+    gzipped through compress_trace_file() or not.
+    """
+    with open(trace_filename, "rb", buffering=PICKLE_BUFFER_SIZE) as raw_f:
+        f = gzip.GzipFile(fileobj=raw_f) if raw_f.peek(2)[:2] == GZIP_MAGIC else raw_f
+        while True:
+            try:
+                yield dequantize_columns(pickle.load(f))
+            except EOFError:
+                return
+
+
+def columns_to_sequence(columns: dict[str, np.ndarray]) -> list[dict]:
+    """
+    Converts the columns of a trace sequence into a list of trace dicts, in the format understood by the Valhalla map
+    matching API.
+    """
+    return [
+        {"time": t, "lon": lon, "lat": lat}
+        for t, lon, lat in zip(
+            columns["time"].tolist(), columns["lon"].tolist(), columns["lat"].tolist()
+        )
+    ]
+
+
+def quantize_columns(columns: dict[str, np.ndarray]) -> dict[str, np.ndarray]:
+    """
+    Returns a copy of columns where the coordinate columns are converted to int32 multiples of 1 /
+    TRACE_COORDINATE_SCALE degrees. Timestamps are left as float64 since the filters rely on sub-second differences.
+    """
+    quantized = dict(columns)
+    for key in TRACE_COORDINATE_COLUMNS:
+        quantized[key] = np.rint(columns[key] * TRACE_COORDINATE_SCALE).astype(np.int32)
+    return quantized
+
+
+def dequantize_columns(columns: dict[str, np.ndarray]) -> dict[str, np.ndarray]:
+    """
+    Reverses quantize_columns(), converting the coordinate columns back into float64 degrees.
+    """
+    dequantized = dict(columns)
+    for key in TRACE_COORDINATE_COLUMNS:
+        dequantized[key] = columns[key] / TRACE_COORDINATE_SCALE
+    return dequantized
+
+
 def get_final_config_filename(results_dir: str) -> str:
     """
     Returns the full filename of where the final config JSON should be stored.
@@ -35,7 +35,9 @@ def main():
     arg_parser.add_argument(
         "--concurrency",
         type=int,
-        help="The number of processes to use to make requests, by default your # of cpus",
+        help="The number of processes to use to make requests, by default your # of cpus. Trace fetching runs several "
+        "threads per process, making up to 32x (mapillary) or 40x (mapillary_v3) this many concurrent Mapillary "
+        "requests. See .README for details.",
         default=multiprocessing.cpu_count(),
     )
     arg_parser.add_argument(
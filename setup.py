@@ -33,7 +33,7 @@ setup(
         "pandas>=1.2.4",
         "ratelimit>=2.2.1",
     ],
-    extras_require={"dev": ["pre-commit", "flake8", "black"]},
+    extras_require={"dev": ["pre-commit", "flake8", "black"], "fast": ["orjson>=3.0.0"]},
     entry_points={"console_scripts": ["conflation=conflation.get_trace_data:main"]},
     license="MIT",
     classifiers=[
@@ -1,94 +1,365 @@
+import copy
+import json
+import numpy as np
+import os
+import tempfile
 import unittest
-from conflation import aggregation
+import urllib.parse
+from conflation import aggregation, trace_filter, util
+from conflation.trace_fetching import mapillary_v3
+
+# perform_interp_extrap() test data, built once rather than on every run of the test
+INTERP_EXTRAP_TEST_CASE = {
+    "iso3166-1": "FR",
+    "rural": {
+        "way": [None, None, 55, 45, None, 30, None, None],
+        "link_exiting": [72, 67, None, 57, 53],
+        "link_turning": [None, 73, 43, 41, None],
+        "roundabout": [40, 31, 25, 24, None, None, None, None],
+        "driveway": 16,
+        "alley": 12,
+        "parking_aisle": 40,
+        "drive-through": 15,
+    },
+    "suburban": {
+        "way": [90, None, None, None, None, None, None, 13],
+        "link_exiting": [None, None, None, None, 45],
+        "link_turning": [50, 62, None, 35, 30],
+        "roundabout": [37, 32, 27, 20, 19, None, None, None],
+        "driveway": 16,
+        "alley": 10,
+        "parking_aisle": 31,
+        "drive-through": 10,
+    },
+    "urban": {
+        "way": [None, None, None, None, None, 20, 15, 10],
+        "link_exiting": [None, None, 23, 59, None],
+        "link_turning": [None, 43, 32, 21, 19],
+        "roundabout": [32, 27, 22, 17, 16, 16, 14, None],
+        "driveway": None,
+        "alley": None,
+        "parking_aisle": None,
+        "drive-through": None,
+    },
+}
+INTERP_EXTRAP_EXPECTED = {
+    "iso3166-1": "FR",
+    "rural": {
+        "way": [75, 65, 55, 45, 38, 30, 22, 14],
+        "link_exiting": [72, 67, 62, 57, 53],
+        "link_turning": [103, 73, 43, 41, 39],
+        "roundabout": [40, 31, 25, 24, 23, 22, 21, 20],
+        "driveway": 16,
+        "alley": 12,
+        "parking_aisle": 40,
+        "drive-through": 15,
+    },
+    "suburban": {
+        "way": [90, 79, 68, 57, 46, 35, 24, 13],
+        "link_exiting": [
+            None,
+            None,
+            None,
+            None,
+            45,
+        ],  # Should skip because not enough data points
+        "link_turning": [
+            50,
+            62,
+            None,
+            35,
+            30,
+        ],  # Should skip because not monotonically decreasing
+        "roundabout": [37, 32, 27, 20, 19, 18, 17, 16],
+        "driveway": 16,
+        "alley": 10,
+        "parking_aisle": 31,
+        "drive-through": 10,
+    },
+    "urban": {
+        "way": [45, 40, 35, 30, 25, 20, 15, 10],
+        "link_exiting": [
+            None,
+            None,
+            23,
+            59,
+            None,
+        ],  # Should skip because not monotonically decreasing
+        "link_turning": [54, 43, 32, 21, 19],
+        "roundabout": [32, 27, 22, 17, 16, 16, 14, 12],
+        "driveway": None,
+        "alley": None,
+        "parking_aisle": None,
+        "drive-through": None,
+    },
+}
 
 
 class TestAggregationInterpExtrap(unittest.TestCase):
     def test_interp_extrap(self):
-        test_case = {
-            "iso3166-1": "FR",
-            "rural": {
-                "way": [None, None, 55, 45, None, 30, None, None],
-                "link_exiting": [72, 67, None, 57, 53],
-                "link_turning": [None, 73, 43, 41, None],
-                "roundabout": [40, 31, 25, 24, None, None, None, None],
-                "driveway": 16,
-                "alley": 12,
-                "parking_aisle": 40,
-                "drive-through": 15,
-            },
-            "suburban": {
-                "way": [90, None, None, None, None, None, None, 13],
-                "link_exiting": [None, None, None, None, 45],
-                "link_turning": [50, 62, None, 35, 30],
-                "roundabout": [37, 32, 27, 20, 19, None, None, None],
-                "driveway": 16,
-                "alley": 10,
-                "parking_aisle": 31,
-                "drive-through": 10,
-            },
-            "urban": {
-                "way": [None, None, None, None, None, 20, 15, 10],
-                "link_exiting": [None, None, 23, 59, None],
-                "link_turning": [None, 43, 32, 21, 19],
-                "roundabout": [32, 27, 22, 17, 16, 16, 14, None],
-                "driveway": None,
-                "alley": None,
-                "parking_aisle": None,
-                "drive-through": None,
-            },
+        self.assertEqual(
+            aggregation.perform_interp_extrap(copy.deepcopy(INTERP_EXTRAP_TEST_CASE)),
+            INTERP_EXTRAP_EXPECTED,
+        )
+
+
+class TestMapillaryV3ParseCapturedAt(unittest.TestCase):
+    def test_parse_captured_at(self):
+        self.assertEqual(
+            mapillary_v3.parse_captured_at("2016-03-14T13:44:37.206Z"), 1457963077.206
+        )
+        # Timestamps with an explicit offset should be respected
+        self.assertEqual(
+            mapillary_v3.parse_captured_at("2016-03-14T14:44:37.206+01:00"), 1457963077.206
+        )
+        # Timestamps that datetime.fromisoformat() rejects should fall back to dateutil
+        self.assertEqual(mapillary_v3.parse_captured_at("2016-03-14T24:00:00Z"), 1458000000.0)
+
+    def test_parse_captured_at_array(self):
+        # The vectorized parse should give the exact same timestamps as the scalar one, with or without UTC offsets
+        for captured_ats in (
+            ["2016-03-14T13:44:37.206Z", "2016-03-14T13:44:38Z", "2021-12-31T23:59:59.999Z"],
+            ["2016-03-14T13:44:37.206Z", "2016-03-14T14:44:38.5+01:00"],
+            ["2016-03-14T13:44:37.206Z", "2021-12-31T23:59:59.999Z"],
+            ["2016-03-14T13:44:37.206Z", "2016-03-14T13:44:38.206+0100"],
+            ["2016-03-14T13:44:37.206Z", "2016-03-14T24:00:00Z"],
+            ["2016-03-14T13:44:37.206Z", "2016-03-14T13:44:37.206123Z"],
+            [],
+        ):
+            self.assertEqual(
+                mapillary_v3.parse_captured_at_array(captured_ats).tolist(),
+                [mapillary_v3.parse_captured_at(c) for c in captured_ats],
+            )
+
+
+class TestMapillaryV3GetSectionBounds(unittest.TestCase):
+    def test_get_section_bounds(self):
+        self.assertEqual(
+            mapillary_v3.get_section_bounds(-1.0, 0.25, 0.5),
+            [("-1.0", "-0.5"), ("-0.5", "0.0"), ("0.0", "0.25")],
+        )
+        # Bounds shouldn't drift from repeatedly adding the section size
+        section_bounds = mapillary_v3.get_section_bounds(0.0, 100.0, 0.1)
+        self.assertEqual(len(section_bounds), 1000)
+        self.assertEqual(section_bounds[-1], (str(999 * 0.1), "100.0"))
+        # Float error in the range shouldn't add an inverted section starting past max_
+        section_bounds = mapillary_v3.get_section_bounds(1, 1.3, 0.1)
+        self.assertEqual(len(section_bounds), 3)
+        self.assertEqual(section_bounds[-1], (str(1 + 2 * 0.1), "1.3"))
+        self.assertTrue(all(float(lower) < float(upper) for lower, upper in section_bounds))
+
+
+class TestTraceFilter(unittest.TestCase):
+    def test_is_valid_sequence(self):
+        # About 21m every 2s (~38 km/h) for 2 minutes, with a stop in the middle
+        times = np.arange(0.0, 122.0, 2.0)
+        times[31:] -= 2
+        sequence = {
+            "time": times,
+            "lon": np.linspace(-74.0, -73.985, len(times)),
+            "lat": np.full(len(times), 40.7),
         }
-        expected = {
-            "iso3166-1": "FR",
-            "rural": {
-                "way": [75, 65, 55, 45, 38, 30, 22, 14],
-                "link_exiting": [72, 67, 62, 57, 53],
-                "link_turning": [103, 73, 43, 41, 39],
-                "roundabout": [40, 31, 25, 24, 23, 22, 21, 20],
-                "driveway": 16,
-                "alley": 12,
-                "parking_aisle": 40,
-                "drive-through": 15,
-            },
-            "suburban": {
-                "way": [90, 79, 68, 57, 46, 35, 24, 13],
-                "link_exiting": [
-                    None,
-                    None,
-                    None,
-                    None,
-                    45,
-                ],  # Should skip because not enough data points
-                "link_turning": [
-                    50,
-                    62,
-                    None,
-                    35,
-                    30,
-                ],  # Should skip because not monotonically decreasing
-                "roundabout": [37, 32, 27, 20, 19, 18, 17, 16],
-                "driveway": 16,
-                "alley": 10,
-                "parking_aisle": 31,
-                "drive-through": 10,
-            },
-            "urban": {
-                "way": [45, 40, 35, 30, 25, 20, 15, 10],
-                "link_exiting": [
-                    None,
-                    None,
-                    23,
-                    59,
-                    None,
-                ],  # Should skip because not monotonically decreasing
-                "link_turning": [54, 43, 32, 21, 19],
-                "roundabout": [32, 27, 22, 17, 16, 16, 14, 12],
-                "driveway": None,
-                "alley": None,
-                "parking_aisle": None,
-                "drive-through": None,
+        self.assertTrue(trace_filter.is_valid_sequence(sequence))
+        # Out-of-order timestamps
+        self.assertFalse(
+            trace_filter.is_valid_sequence({**sequence, "time": times[::-1].copy()})
+        )
+        # Far too fast between most of the points
+        self.assertFalse(
+            trace_filter.is_valid_sequence(
+                {**sequence, "lon": np.linspace(-74.0, -73.4, len(times))}
+            )
+        )
+
+    def test_get_adjacent_distances(self):
+        degree = np.pi * trace_filter.EARTH_RADIUS / 180
+        self.assertAlmostEqual(degree, 111319.8, places=0)
+        # A degree of longitude on the equator, a degree of latitude along a meridian, then no movement
+        np.testing.assert_allclose(
+            trace_filter.get_adjacent_distances(
+                np.array([0.0, 1.0, 1.0, 1.0]), np.array([0.0, 0.0, 1.0, 1.0])
+            ),
+            [degree, degree, 0.0],
+        )
+        # Half way around the equator
+        np.testing.assert_allclose(
+            trace_filter.get_adjacent_distances(np.array([0.0, 180.0]), np.zeros(2)),
+            [180 * degree],
+        )
+        # A degree of longitude at 60 degrees latitude is about half as long as on the equator
+        np.testing.assert_allclose(
+            trace_filter.get_adjacent_distances(np.array([0.0, 1.0]), np.full(2, 60.0)),
+            [degree / 2],
+            atol=1,
+        )
+
+
+class TestUtilPickle(unittest.TestCase):
+    def test_dump_and_load_pickle(self):
+        bbox_sections = [
+            ("0.0,0.0,0.25,0.25", "ab/1234.pickle"),
+            ("0.25,0.0,0.5,0.25", "cd/5678.pickle"),
+        ]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filename = os.path.join(tmp_dir, "sections.pickle")
+            util.dump_pickle(bbox_sections, filename, sync=True)
+            self.assertEqual(util.load_pickle(filename), bbox_sections)
+
+
+class TestUtilTraceSequences(unittest.TestCase):
+    def test_dump_and_load_trace_sequences(self):
+        sequences = [
+            {
+                "time": np.array([1.0, 2.0]),
+                "lon": np.array([2.0, 2.5]),
+                "lat": np.array([3.0, 3.5]),
             },
-        }
-        self.assertEqual(aggregation.perform_interp_extrap(test_case), expected)
+            {"time": np.array([5.0]), "lon": np.array([-1.0]), "lat": np.array([-2.0])},
+        ]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            trace_filename = os.path.join(tmp_dir, "traces.pickle")
+            # Both compressed and uncompressed trace files should be read back
+            for compress in (True, False):
+                with open(trace_filename, "wb") as f:
+                    if compress:
+                        with util.compress_trace_file(f) as compressed_f:
+                            util.dump_trace_sequences(iter(sequences), compressed_f)
+                    else:
+                        util.dump_trace_sequences(iter(sequences), f)
+                self.assertEqual(
+                    [
+                        util.columns_to_sequence(s)
+                        for s in util.load_trace_sequences(trace_filename)
+                    ],
+                    [util.columns_to_sequence(s) for s in sequences],
+                )
+
+
+class FakeResponse:
+    def __init__(self, content, links):
+        self.content = content
+        self.links = links
+        self.status_code = 200
+
+
+class FakeSession:
+    def __init__(self):
+        self.urls = []
+
+    def get(self, url, timeout=None):
+        self.urls.append(url)
+        return FakeResponse(b'{"features": [1, 2]}', {"next": {"url": url + "&page=2"}})
+
+
+class FakeMapillaryV3Session:
+    """
+    Serves num_sequences sequences of 10 images each from the v3 sequences and images APIs, 10 sequences per page
+    """
+
+    def __init__(self, num_sequences):
+        self.num_sequences = num_sequences
+        # The sequence keys of each images request
+        self.image_seq_ids = []
+
+    def get(self, url, timeout=None):
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)
+        page = int(query["page"][-1]) if "page" in query else 1
+        if "/sequences_without_images" in url:
+            features = [
+                {
+                    "properties": {"key": "seq{}".format(i)},
+                    "geometry": {"coordinates": [[0.1, 0.1]] * 10},
+                }
+                for i in range((page - 1) * 10, min(page * 10, self.num_sequences))
+            ]
+            has_next = page * 10 < self.num_sequences
+        else:
+            self.image_seq_ids.append(query["sequence_keys"][-1].split(","))
+            # Latest image first, like Mapillary
+            features = [
+                {
+                    "properties": {
+                        "sequence_key": seq_id,
+                        "captured_at": "2021-01-01T00:00:{:02d}.000Z".format(i),
+                    },
+                    "geometry": {"coordinates": [0.1 + i / 1000, 0.1]},
+                }
+                for seq_id in query["sequence_keys"][-1].split(",")
+                for i in reversed(range(10))
+            ]
+            has_next = False
+        links = {"next": {"url": url + "&page={}".format(page + 1)}} if has_next else {}
+        return FakeResponse(json.dumps({"features": features}).encode("UTF-8"), links)
+
+
+class TestMapillaryV3PullFilterAndSave(unittest.TestCase):
+    def test_pull_filter_and_save_trace_for_bbox(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # Braces in the dirs (e.g. from the working dir) shouldn't break building the output filenames
+            tmp_dir = os.path.join(tmp_dir, "{proj}")
+            os.mkdir(tmp_dir)
+            trace_filename = os.path.join(tmp_dir, "0_0_1_1.pickle")
+            mapillary_v3.pull_filter_and_save_trace_for_bbox(
+                ("0,0,1,1", trace_filename),
+                FakeMapillaryV3Session(0),
+                os.path.join(tmp_dir, ""),
+                {"client_id": "a"},
+                set(),
+            )
+            self.assertEqual(list(util.load_trace_sequences(trace_filename)), [])
+
+    def test_make_trace_data_requests(self):
+        group_size = mapillary_v3.SEQUENCE_KEYS_PER_IMAGES_REQUEST
+        # Full groups only, and full groups followed by a partial one
+        for num_sequences in (2 * group_size, 2 * group_size + 5):
+            session = FakeMapillaryV3Session(num_sequences)
+            trace_data = mapillary_v3.make_trace_data_requests(
+                session, "0,0,1,1", {"client_id": "a"}
+            )
+            # Every sequence should have its images pulled exactly once, in groups of consecutive sequences
+            seq_ids = ["seq{}".format(i) for i in range(num_sequences)]
+            self.assertEqual(
+                sorted(session.image_seq_ids),
+                [seq_ids[i : i + group_size] for i in range(0, num_sequences, group_size)],
+            )
+            self.assertEqual(len(trace_data), num_sequences)
+            for sequence in trace_data:
+                np.testing.assert_array_equal(sequence["time"], np.arange(10) + 1609459200.0)
+                np.testing.assert_allclose(sequence["lon"], 0.1 + np.arange(10) / 1000)
+
+
+class TestUtilGetJsonPage(unittest.TestCase):
+    def test_get_json_page_cache(self):
+        session = FakeSession()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for _ in range(2):
+                self.assertEqual(
+                    util.get_json_page(
+                        session, "https://a?token=1", tmp_dir, cache_key="https://a"
+                    ),
+                    ({"features": [1, 2]}, "https://a?token=1&page=2"),
+                )
+            # Only the first call should have hit the API, even with a different token
+            util.get_json_page(session, "https://a?token=2", tmp_dir, cache_key="https://a")
+        self.assertEqual(session.urls, ["https://a?token=1"])
+
+    def test_get_json_page_corrupt_cache(self):
+        session = FakeSession()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            util.get_json_page(session, "https://a", tmp_dir)
+            (cache_filename,) = util.get_existing_filenames(tmp_dir)
+            with open(cache_filename, "rb") as f:
+                entry = f.read()
+            # An empty or truncated entry should be pulled again and overwritten
+            for corrupt_entry in [b"", entry[: len(entry) // 2]]:
+                with open(cache_filename, "wb") as f:
+                    f.write(corrupt_entry)
+                self.assertEqual(
+                    util.get_json_page(session, "https://a", tmp_dir),
+                    ({"features": [1, 2]}, "https://a&page=2"),
+                )
+                self.assertEqual(util.load_pickle(cache_filename)[1], "https://a&page=2")
+        self.assertEqual(session.urls, ["https://a"] * 3)
 
 
 if __name__ == "__main__":